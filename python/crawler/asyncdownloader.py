@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+
+"""
+Provide asynchronous download function by aiohttp
+"""
+
+import asyncio
+import logging
+import time
+import urllib.parse
+
+import aiohttp
+
+from downloader import Throttle
+from metrics import Metrics
+from retry import RetryPolicy
+
+
+# exceptions retried unless the RetryPolicy names its own
+RETRY_EXCEPTIONS = (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError,
+                    asyncio.TimeoutError)
+
+
+def build_url(url, params=None):
+    """Append the query parameters to url, the key used by the cache."""
+    if not params:
+        return url
+    query = urllib.parse.urlencode(params, doseq=True)
+    return url + ('&' if urllib.parse.urlparse(url).query else '?') + query
+
+
+class AsyncDownloader(object):
+    """Asyncio counterpart of Downloader, many requests share one event loop.
+
+    >>> async def main(urls):
+    ...     async with AsyncDownloader(delay=0) as D:
+    ...         return await asyncio.gather(*[D.text(url) for url in urls])
+
+    Args:
+        delay: Interval between downloads (seconds)
+        num_retries: Number of retries when downloading errors
+        timeout: Download timeout
+        retry: retry.RetryPolicy used instead of RetryPolicy(num_retries)
+        max_connections: Number of requests in flight at the same time
+        max_per_domain: Number of requests in flight for the same domain
+        throttle: Object with a `reserve(url)` method used instead of
+            Throttle(delay), e.g. scheduler.DomainScheduler
+        metrics: metrics.Metrics collecting the counters and timings of the
+            downloads per domain, DNS and connect times included
+        cache: Cache with the MongoCache interface, read and written in
+            the default executor so that its I/O does not block the loop
+    """
+    def __init__(self, delay=5, user_agent='awsl', proxy=None, num_retries=1,
+                 timeout=60, cache=None, auth=None, max_connections=1000,
+                 max_per_domain=8, throttle=None, retry=None, metrics=None):
+        self.headers = {'user-agent': user_agent}
+        self.proxy = proxy
+        self.auth = aiohttp.BasicAuth(*auth) if auth else None
+        self.throttle = Throttle(delay) if throttle is None else throttle
+        self.retry = RetryPolicy(num_retries) if retry is None else retry
+        self.num_retries = self.retry.num_retries
+        self.timeout = timeout
+        self.cache = cache
+        self.max_connections = max_connections
+        self.max_per_domain = max_per_domain
+        self.metrics = Metrics() if metrics is None else metrics
+        # domain -> [semaphore, number of users], dropped when unused
+        self.domains = {}
+        self.session = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def open(self):
+        """Create the client session, must be called inside the event loop."""
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.max_connections)
+            self.session = aiohttp.ClientSession(
+                headers=self.headers, auth=self.auth, connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                trace_configs=[self.trace_config()])
+
+    def trace_config(self):
+        """Time the DNS lookups and connections opened by the session."""
+        metrics = self.metrics
+
+        async def on_request_start(session, context, params):
+            context.domain = params.url.raw_authority
+
+        def timer(name):
+            async def on_start(session, context, params):
+                setattr(context, name, time.monotonic())
+
+            async def on_end(session, context, params):
+                metrics.observe(name, time.monotonic() - getattr(context, name),
+                                getattr(context, 'domain', ''))
+            return on_start, on_end
+
+        config = aiohttp.TraceConfig()
+        config.on_request_start.append(on_request_start)
+        start, end = timer('dns_seconds')
+        config.on_dns_resolvehost_start.append(start)
+        config.on_dns_resolvehost_end.append(end)
+        start, end = timer('connect_seconds')
+        config.on_connection_create_start.append(start)
+        config.on_connection_create_end.append(end)
+        return config
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def get_from_cache(self, url, kind):
+        """Try to get the result of the request from the cache."""
+        result = None
+        if self.cache:
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(None, self.cache.get, url)
+            if result and kind not in result:
+                # downloaded as the other kind
+                result = None
+            if result and self.num_retries > 0 and 500 <= result['code'] < 600:
+                result = None
+            domain = urllib.parse.urlparse(url).netloc
+            self.metrics.inc('cache_misses' if result is None else 'cache_hits', domain)
+        return result
+
+    async def send_request(self, url, kind, encoding, num_retries):
+        """Send request and return the result dict, see Downloader.send_request."""
+        retry = self.retry
+        metrics = self.metrics
+        exceptions = retry.exceptions or RETRY_EXCEPTIONS
+        domain = urllib.parse.urlparse(url).netloc
+        slot = self.domains.setdefault(
+            domain, [asyncio.Semaphore(self.max_per_domain), 0])
+        slot[1] += 1
+        try:
+            attempt = 0
+            while True:
+                if not retry.allow(domain):
+                    logging.warning('Host is failing, skipped: %s' % url)
+                    metrics.inc('circuit_open', domain)
+                    return None
+                # the slot is not held while waiting to retry
+                async with slot[0]:
+                    wait = self.throttle.reserve(url)
+                    metrics.observe('throttle_seconds', wait, domain)
+                    await asyncio.sleep(wait)
+                    metrics.inc('requests', domain)
+                    result = retry_after = None
+                    try:
+                        result, retry_after = await self._request(url, kind, encoding, domain)
+                    except exceptions as e:
+                        logging.warning('Download error: %s' % e)
+                        metrics.inc('errors', domain)
+                    except (aiohttp.ClientError, ValueError):
+                        logging.error('Download faild: %s' % url)
+                        metrics.inc('errors', domain)
+                        return None
+                if result is not None and not retry.retry_status(result['code']):
+                    retry.success(domain)
+                    return result
+                retry.failure(domain)
+
+                delay = retry.delay(attempt, retry_after) if attempt < num_retries else None
+                if delay is None:
+                    if result is None:
+                        logging.error('Download faild: %s' % url)
+                    return result
+                metrics.inc('retries', domain)
+                await asyncio.sleep(delay)
+                attempt += 1
+        finally:
+            slot[1] -= 1
+            if not slot[1]:
+                del self.domains[domain]
+
+    async def _request(self, url, kind, encoding, domain):
+        """Return the result dict and the Retry-After header of url."""
+        logging.info('Downloading: %s' % url)
+        metrics = self.metrics
+        start = time.monotonic()
+        async with self.session.get(url, proxy=self.proxy) as response:
+            metrics.observe('ttfb_seconds', time.monotonic() - start, domain)
+            metrics.inc('responses_%dxx' % (response.status // 100), domain)
+            if response.status >= 400:
+                logging.warning('Download error: %s %s' % (response.status, url))
+            # the body is kept by the response for text() and json()
+            metrics.inc('bytes', domain, len(await response.read()))
+            metrics.observe('request_seconds', time.monotonic() - start, domain)
+            if kind == 'json':
+                body = await response.json(content_type=None)
+            else:
+                body = await response.text(encoding=encoding)
+            return {kind: body, 'code': response.status}, response.headers.get('Retry-After')
+
+    async def fetch(self, url, params=None, encoding=None, kind='text'):
+        """Download url and return the result dict, None if it failed."""
+        if self.session is None:
+            await self.open()
+        url = build_url(url, params)
+        result = await self.get_from_cache(url, kind)
+        if result is None:
+            result = await self.send_request(url, kind, encoding, self.num_retries)
+            if result and self.cache:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self.cache.__setitem__, url, result)
+        return result
+
+    async def text(self, url, params=None, encoding=None):
+        """Download web content in text format or html."""
+        result = await self.fetch(url, params, encoding, 'text')
+        return result['text'] if result else None
+
+    async def json(self, url, params=None):
+        """Access the api and return the json object."""
+        result = await self.fetch(url, params, kind='json')
+        return result['json'] if result else None
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks of the crawler components
+
+Usage (from this directory, the parent one holds the net package):
+    python benchmark.py downloader -n 2000 -l 0.02
+    python benchmark.py mongocache -n 10000 [--host localhost]
+    python benchmark.py codec --corpus pages/
+    python benchmark.py sqlite -n 10000 [--host localhost]
+    python benchmark.py links --corpus pages/ [-w 4]
+"""
+
+import argparse
+import asyncio
+import glob
+import http.server
+import os
+import random
+import shutil
+import threading
+import time
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    """Answer every GET with the same small page over keep-alive connections.
+
+    `latency` seconds are slept before answering to simulate a remote server.
+    """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    body = b'<html><body>' + b'x' * 1024 + b'</body></html>'
+    latency = 0
+
+    def do_GET(self):
+        if self.latency:
+            time.sleep(self.latency)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def stub_server(handler=StubHandler):
+    """Start a local http server in a daemon thread, return it and its base url."""
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://%s:%d' % server.server_address
+
+
+def report(name, count, elapsed, unit='ops'):
+    print('%-24s %8d %s in %7.3fs  %10.1f %s/s' % (
+        name, count, unit, elapsed, count / elapsed, unit))
+
+
+def bench_downloader(args):
+    """Requests per second of Downloader, its fetch_many and AsyncDownloader."""
+    from downloader import Downloader
+    from asyncdownloader import AsyncDownloader
+
+    StubHandler.latency = args.latency
+    server, base = stub_server()
+    urls = ['%s/page/%d' % (base, i) for i in range(args.number)]
+
+    D = Downloader(delay=0)
+    start = time.perf_counter()
+    for url in urls:
+        D.text(url)
+    report('Downloader', len(urls), time.perf_counter() - start, 'req')
+
+    D = Downloader(delay=0, pool_maxsize=args.concurrency)
+    start = time.perf_counter()
+    for url, text in D.fetch_many(urls, max_workers=args.concurrency):
+        pass
+    report('Downloader.fetch_many', len(urls), time.perf_counter() - start, 'req')
+
+    async def crawl():
+        async with AsyncDownloader(delay=0, max_per_domain=args.concurrency) as D:
+            await asyncio.gather(*[D.text(url) for url in urls])
+
+    start = time.perf_counter()
+    asyncio.run(crawl())
+    report('AsyncDownloader', len(urls), time.perf_counter() - start, 'req')
+    server.shutdown()
+
+
+def mongo_client(host):
+    """Client of the mongod at host, or an in-memory mongomock stand-in."""
+    if host:
+        from pymongo import MongoClient
+        return MongoClient(host)
+    import mongomock
+    return mongomock.MongoClient()
+
+
+def bench_mongocache(args):
+    """Operations per second of MongoCache single against bulk calls."""
+    from mongocache import MongoCache, WriteBehindCache
+
+    cache = MongoCache(client=mongo_client(args.host))
+    cache.clear()
+    result = {'text': '<html>' + 'x' * args.size + '</html>', 'code': 200}
+    urls = ['http://example.com/%d' % i for i in range(args.number)]
+
+    start = time.perf_counter()
+    for url in urls:
+        cache[url] = result
+    report('__setitem__', len(urls), time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for url in urls:
+        cache[url]
+    report('__getitem__', len(urls), time.perf_counter() - start)
+
+    cache.clear()
+    start = time.perf_counter()
+    for i in range(0, len(urls), args.batch):
+        cache.set_many({url: result for url in urls[i:i + args.batch]})
+    report('set_many', len(urls), time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(0, len(urls), args.batch):
+        cache.get_many(urls[i:i + args.batch])
+    report('get_many', len(urls), time.perf_counter() - start)
+
+    cache.clear()
+    start = time.perf_counter()
+    buffered = WriteBehindCache(cache, max_items=args.batch)
+    for url in urls:
+        buffered[url] = result
+    buffered.close()
+    report('WriteBehindCache', len(urls), time.perf_counter() - start)
+    cache.clear()
+
+
+def load_corpus(directory, number=200):
+    """Pages saved as *.html under directory, or generated ones without it."""
+    if directory:
+        pages = []
+        for filename in sorted(glob.glob(os.path.join(directory, '**', '*.htm*'),
+                                         recursive=True)):
+            with open(filename, encoding='utf-8', errors='replace') as fp:
+                pages.append(fp.read())
+        return pages
+    rand = random.Random(0)
+    words = ['crawler', 'cache', 'page', 'link', 'python', 'mongo', 'domain',
+             'download', 'request', 'queue', 'html', 'parser', 'index']
+    pages = []
+    for i in range(number):
+        items = ''.join(
+            '<li><a href="/item/%d">%s</a> %s</li>\n' % (
+                rand.randint(0, 10 ** 6), rand.choice(words),
+                ' '.join(rand.choice(words) for _ in range(rand.randint(5, 40))))
+            for _ in range(rand.randint(20, 400)))
+        pages.append('<html><head><title>page %d</title></head>'
+                     '<body><ul>\n%s</ul></body></html>' % (i, items))
+    return pages
+
+
+def bench_codec(args):
+    """Size and speed of the cache codecs on a corpus of html pages."""
+    import codec
+
+    pages = load_corpus(args.corpus)
+    results = [{'text': page, 'code': 200} for page in pages]
+    raw = sum(len(page.encode('utf-8')) for page in pages)
+    print('%d pages, %.1f MB' % (len(results), raw / 1e6))
+    print('%-18s %8s %12s %12s' % ('codec', 'ratio', 'encode MB/s', 'decode MB/s'))
+    for serializer in sorted(codec.SERIALIZERS):
+        for compressor, levels in (('none', [0]), ('zlib', [1, 6, 9]), ('lzma', [0, 6])):
+            for level in levels:
+                c = codec.Codec(serializer, compressor, level=level, threshold=0)
+                start = time.perf_counter()
+                encoded = [c.encode(result) for result in results]
+                encode_time = time.perf_counter() - start
+                start = time.perf_counter()
+                for codec_id, data in encoded:
+                    codec.Codec.decode(codec_id, data)
+                decode_time = time.perf_counter() - start
+                size = sum(len(data) for _, data in encoded)
+                print('%-18s %8.3f %12.1f %12.1f' % (
+                    '%s:%s:%d' % (serializer, compressor, level), size / raw,
+                    raw / 1e6 / encode_time, raw / 1e6 / decode_time))
+
+
+def bench_sqlite(args):
+    """Throughput of the SQLite cache and queue against the MongoDB ones."""
+    import tempfile
+    from mongocache import MongoCache
+    from mongoqueue import MongoQueue
+    from sqlitecache import SQLiteCache
+    from sqlitequeue import SQLiteQueue
+
+    directory = tempfile.mkdtemp()
+    client = mongo_client(args.host)
+    result = {'text': '<html>' + 'x' * args.size + '</html>', 'code': 200}
+    urls = ['http://example.com/%d' % i for i in range(args.number)]
+
+    caches = [('SQLiteCache', SQLiteCache(os.path.join(directory, 'cache.db'))),
+              ('MongoCache', MongoCache(client=client))]
+    for name, cache in caches:
+        cache.clear()
+        start = time.perf_counter()
+        for url in urls:
+            cache[url] = result
+        report(name + ' set', len(urls), time.perf_counter() - start)
+        start = time.perf_counter()
+        for url in urls:
+            cache[url]
+        report(name + ' get', len(urls), time.perf_counter() - start)
+        cache.clear()
+
+    queues = [('SQLiteQueue', SQLiteQueue(os.path.join(directory, 'queue.db'))),
+              ('MongoQueue', MongoQueue(client=client))]
+    for name, queue in queues:
+        queue.clear()
+        start = time.perf_counter()
+        for url in urls:
+            queue.put(url)
+        report(name + ' put', len(urls), time.perf_counter() - start)
+        start = time.perf_counter()
+        for _ in urls:
+            queue.complete(queue.get())
+        report(name + ' get+complete', len(urls), time.perf_counter() - start)
+        queue.clear()
+    shutil.rmtree(directory)
+
+
+def bench_links(args):
+    """Pages per second of link extraction against BeautifulSoup."""
+    import urllib.parse
+    from bs4 import BeautifulSoup
+    import links
+
+    pages = load_corpus(args.corpus)
+    pages = [('http://example.com/%d/' % i, page) for i, page in enumerate(pages)]
+
+    def soup_links(url, text, features):
+        soup = BeautifulSoup(text, features)
+        found = [tag.get(name) for tag in soup.find_all(list(links.LINK_ATTRIBUTES))
+                 for name in [links.LINK_ATTRIBUTES[tag.name]] if tag.get(name)]
+        return [urllib.parse.urljoin(url, link) for link in found]
+
+    for features in ('html.parser', 'lxml'):
+        start = time.perf_counter()
+        for url, text in pages:
+            soup_links(url, text, features)
+        report('BeautifulSoup ' + features, len(pages), time.perf_counter() - start, 'pages')
+
+    for parser in ('html.parser', 'lxml'):
+        start = time.perf_counter()
+        for url, text in pages:
+            links.extract_links(url, text, parser)
+        report('extract_links ' + parser, len(pages), time.perf_counter() - start, 'pages')
+
+    with links.LinkExtractor(args.workers) as extractor:
+        # the processes are started before the clock
+        list(extractor.map(pages[:args.workers or 1], chunksize=1))
+        start = time.perf_counter()
+        for url, found in extractor.map(pages):
+            pass
+        report('LinkExtractor', len(pages), time.perf_counter() - start, 'pages')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='crawler benchmarks.')
+    subparsers = parser.add_subparsers(dest='bench', required=True)
+
+    sub = subparsers.add_parser('downloader', help=bench_downloader.__doc__)
+    sub.add_argument('-n', '--number', type=int, default=2000)
+    sub.add_argument('-c', '--concurrency', type=int, default=100)
+    sub.add_argument('-l', '--latency', type=float, default=0.02,
+                     help='seconds the stub server waits before answering')
+    sub.set_defaults(func=bench_downloader)
+
+    sub = subparsers.add_parser('mongocache', help=bench_mongocache.__doc__)
+    sub.add_argument('-n', '--number', type=int, default=10000)
+    sub.add_argument('-b', '--batch', type=int, default=500)
+    sub.add_argument('-s', '--size', type=int, default=4096,
+                     help='bytes of every cached page')
+    sub.add_argument('--host', help='mongod to use instead of mongomock')
+    sub.set_defaults(func=bench_mongocache)
+
+    sub = subparsers.add_parser('codec', help=bench_codec.__doc__)
+    sub.add_argument('--corpus', help='directory of saved html pages')
+    sub.set_defaults(func=bench_codec)
+
+    sub = subparsers.add_parser('sqlite', help=bench_sqlite.__doc__)
+    sub.add_argument('-n', '--number', type=int, default=10000)
+    sub.add_argument('-s', '--size', type=int, default=4096,
+                     help='bytes of every cached page')
+    sub.add_argument('--host', help='mongod to use instead of mongomock')
+    sub.set_defaults(func=bench_sqlite)
+
+    sub = subparsers.add_parser('links', help=bench_links.__doc__)
+    sub.add_argument('--corpus', help='directory of saved html pages')
+    sub.add_argument('-w', '--workers', type=int, help='processes of LinkExtractor')
+    sub.set_defaults(func=bench_links)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+"""
+Append-only journal of an in-memory crawl, to resume it after a crash
+"""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+
+
+class Checkpoint(object):
+    """Journal of the URLs queued, started and done by a crawl.
+
+    Every change is one JSON line appended to a buffered file, flushed every
+    `interval` seconds by a background thread, so a crash loses at most
+    the last interval: lost puts are rediscovered, lost completions are
+    downloaded again. The journal is compacted to the live URLs once it
+    holds `compact_ratio` times more lines, after the seen-set is saved
+    next to it in `path + '.seen'`.
+
+    >>> import tempfile, os
+    >>> path = os.path.join(tempfile.mkdtemp(), 'crawl.journal')
+    >>> journal = Checkpoint(path)
+    >>> journal.restore()
+    []
+    >>> for url in ['a', 'b', 'c']:
+    ...     journal.put(url)
+    >>> journal.start('a'); journal.done('a'); journal.start('b')
+    >>> journal.close()
+    >>> Checkpoint(path).restore() # b was in flight, c queued
+    [('b', None), ('c', None)]
+    >>> journal = Checkpoint(path); _ = journal.restore()
+    >>> journal.put('d\\te', 1); journal.close()
+    >>> with open(path, 'a') as fp: # torn by a crash
+    ...     _ = fp.write('["P", "f')
+    >>> Checkpoint(path).restore()
+    [('b', None), ('c', None), ('d\\te', 1)]
+
+    Args:
+        path: File of the journal
+        seen: seen.SeenSet of the crawl, saved when the journal is
+            compacted and filled with the journal when it is restored
+        interval: Seconds between flushes of the journal
+        compact_ratio: Lines per live URL above which the journal is compacted
+        fsync: Whether flushes also survive a power loss, not only a crash
+    """
+    def __init__(self, path, seen=None, interval=5, compact_ratio=4, fsync=False):
+        self.path = path
+        self.seen = seen
+        self.interval = interval
+        self.compact_ratio = compact_ratio
+        self.fsync = fsync
+        # url -> priority of the queued and the started URLs
+        self.pending = {}
+        self.inflight = {}
+        self.lines = 0
+        self.fp = None
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.flusher = None
+
+    def restore(self):
+        """Read the journal and start appending to it.
+
+        Return the (url, priority) pairs to queue again, the ones in flight
+        at the time of the crash first.
+        """
+        if self.seen is not None and os.path.exists(self.path + '.seen'):
+            self.seen.load(self.path + '.seen')
+        if os.path.exists(self.path):
+            with open(self.path, encoding='utf-8', newline='\n') as fp:
+                bad = sum(not self.replay(line) for line in fp)
+            if bad:
+                logging.warning('Skipped %d unreadable lines of %s' % (bad, self.path))
+        logging.info('Restored %d queued and %d in-flight URLs from %s' % (
+            len(self.pending), len(self.inflight), self.path))
+        # in-flight URLs are queued again, before the others
+        self.pending = dict(self.inflight, **self.pending)
+        self.inflight = {}
+        self.rewrite()
+        self.flusher = threading.Thread(target=self.run, daemon=True)
+        self.flusher.start()
+        return list(self.pending.items())
+
+    def replay(self, line):
+        """Apply a line of the journal, return False if it is unreadable,
+        e.g. the last one torn by a crash.
+        """
+        try:
+            op, url, priority = json.loads(line)
+        except (TypeError, ValueError):
+            return False
+        if op == 'P':
+            self.pending[url] = priority
+            if self.seen is not None:
+                self.seen.add(url)
+        elif op == 'S':
+            self.inflight[url] = self.pending.pop(url, None)
+        elif op == 'D':
+            self.inflight.pop(url, None)
+            self.pending.pop(url, None)
+        return True
+
+    def write(self, op, url, priority=None):
+        # called under the lock
+        self.fp.write(record(op, url, priority))
+        self.lines += 1
+
+    def put(self, url, priority=None):
+        with self.lock:
+            self.pending[url] = priority
+            self.write('P', url, priority)
+
+    def start(self, url):
+        with self.lock:
+            self.inflight[url] = self.pending.pop(url, None)
+            self.write('S', url)
+
+    def done(self, url):
+        with self.lock:
+            self.inflight.pop(url, None)
+            self.write('D', url)
+
+    def flush(self):
+        with self.lock:
+            self.fp.flush()
+            if self.fsync:
+                os.fsync(self.fp.fileno())
+
+    def rewrite(self):
+        """Replace the journal by the puts of the live URLs."""
+        if self.seen is not None:
+            # saved first, the old journal is still complete if this fails
+            self.seen.save(self.path + '.seen')
+        with self.lock:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)))
+            with os.fdopen(fd, 'w', encoding='utf-8', newline='\n') as fp:
+                for url, priority in self.inflight.items():
+                    fp.write(record('P', url, priority))
+                    fp.write(record('S', url))
+                for url, priority in self.pending.items():
+                    fp.write(record('P', url, priority))
+                fp.flush()
+                os.fsync(fp.fileno())
+            if self.fp is not None:
+                self.fp.close()
+            os.replace(tmp, self.path)
+            self.fp = open(self.path, 'a', encoding='utf-8', newline='\n',
+                           buffering=1024 * 1024)
+            self.lines = 2 * len(self.inflight) + len(self.pending)
+
+    def run(self):
+        while not self.closed.wait(self.interval):
+            live = len(self.pending) + len(self.inflight)
+            if self.lines > self.compact_ratio * max(live, 10000):
+                self.rewrite()
+            else:
+                self.flush()
+
+    def close(self):
+        """Stop the flusher and compact the journal."""
+        self.closed.set()
+        if self.flusher is not None:
+            self.flusher.join()
+        self.rewrite()
+        with self.lock:
+            self.fp.close()
+
+
+def record(op, url, priority=None):
+    """Line of the journal, escaped so that no URL can break it."""
+    return json.dumps([op, url, priority]) + '\n'
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+
+"""
+Serialization and compression of cached values
+"""
+
+from datetime import datetime
+import json
+import lzma
+import pickle
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def _default(obj):
+    # results keep datetime values, which json and msgpack can not encode
+    if isinstance(obj, datetime):
+        return {'$date': obj.isoformat()}
+    raise TypeError('%r is not serializable' % obj)
+
+
+def _object_hook(obj):
+    if len(obj) == 1 and '$date' in obj:
+        return datetime.fromisoformat(obj['$date'])
+    return obj
+
+
+SERIALIZERS = {
+    'pickle': (lambda value: pickle.dumps(value, 5), pickle.loads),
+    'json': (lambda value: json.dumps(value, default=_default).encode('utf-8'),
+             lambda data: json.loads(bytes(data), object_hook=_object_hook)),
+}
+
+if msgpack is not None:
+    SERIALIZERS['msgpack'] = (
+        lambda value: msgpack.packb(value, default=_default, use_bin_type=True),
+        lambda data: msgpack.unpackb(data, object_hook=_object_hook, raw=False))
+
+COMPRESSORS = {
+    'zlib': (zlib.compress, zlib.decompress),
+    'lzma': (lambda data, level: lzma.compress(data, preset=level), lzma.decompress),
+    'none': (lambda data, level: data, lambda data: data),
+}
+
+# how values stored before codecs were recorded are encoded
+LEGACY = 'pickle:zlib'
+
+
+class Codec(object):
+    """Encode values into bytes tagged with the id of the codec used.
+
+    The id is stored along with the bytes, so that values keep decoding
+    after the codec of the writer changed.
+
+    >>> codec = Codec('json', 'zlib', level=1, threshold=0)
+    >>> codec.encode({'a': 1})[0]
+    'json:zlib'
+    >>> codec.decode(*codec.encode({'a': 1}))
+    {'a': 1}
+    >>> Codec(threshold=1024).encode('small')[0]
+    'pickle:none'
+
+    Args:
+        serializer: 'pickle' (protocol 5), 'json' or 'msgpack' when installed
+        compressor: 'zlib', 'lzma' or 'none'
+        level: Compression level, 0-9
+        threshold: Serialized values smaller than it are not compressed
+    """
+    def __init__(self, serializer='pickle', compressor='zlib', level=6, threshold=1024):
+        if serializer not in SERIALIZERS:
+            raise ValueError('unknown serializer: %s' % serializer)
+        if compressor not in COMPRESSORS:
+            raise ValueError('unknown compressor: %s' % compressor)
+        self.serializer = serializer
+        self.compressor = compressor
+        self.level = level
+        self.threshold = threshold
+        self.id = '%s:%s' % (serializer, compressor)
+
+    def encode(self, value):
+        """Return (codec id, bytes) of value."""
+        data = SERIALIZERS[self.serializer][0](value)
+        if len(data) < self.threshold:
+            return '%s:none' % self.serializer, data
+        return self.id, COMPRESSORS[self.compressor][0](data, self.level)
+
+    @staticmethod
+    def decode(codec_id, data):
+        """Return the value of bytes encoded by the codec codec_id."""
+        serializer, compressor = (codec_id or LEGACY).split(':')
+        return SERIALIZERS[serializer][1](COMPRESSORS[compressor][1](data))
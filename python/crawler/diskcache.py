@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+"""
+Cache support via the local file system
+"""
+
+from datetime import timedelta
+import hashlib
+import mmap
+import os
+import shutil
+import tempfile
+import time
+
+from codec import Codec
+
+
+class DiskCache(object):
+    """
+    Store downloads in files under hashed and sharded directories
+
+    >>> import tempfile
+    >>> cache = DiskCache(tempfile.mkdtemp())
+    >>> url = 'http://example.webscraping.com'
+    >>> result = {'html': '...'}
+    >>> cache[url] = result
+    >>> cache[url]['html'] == result['html']
+    True
+    >>> cache = DiskCache(cache.cache_dir, expires=timedelta())
+    >>> cache[url] = result
+    >>> cache[url]
+    Traceback (most recent call last):
+     ...
+    KeyError: 'http://example.webscraping.com does not exist'
+    """
+    def __init__(self, cache_dir='cache', expires=timedelta(days=30), codec=None,
+                 mmap_threshold=1024 * 1024):
+        """
+        cache_dir: root directory of the cache
+        expires: timedelta of amount of time before a cache entry is considered expired
+        codec: codec.Codec used to store values
+        mmap_threshold: files of at least this many bytes are read through mmap
+        """
+        self.cache_dir = cache_dir
+        self.expires = expires
+        self.codec = Codec() if codec is None else codec
+        self.mmap_threshold = mmap_threshold
+        # appended with the expiry time of every write, so that purge()
+        # does not have to walk the directories
+        self.index = os.path.join(cache_dir, 'index')
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, url):
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        """Path of the file for key, sharded over two directory levels."""
+        return os.path.join(self.cache_dir, key[:2], key[2:4], key)
+
+    def read_header(self, fp):
+        """Return (codec id, expiry timestamp) from the first line of fp."""
+        codec_id, expires = fp.readline().decode('ascii').split()
+        return codec_id, float(expires)
+
+    def __contains__(self, url):
+        try:
+            with open(self.path(self.key(url)), 'rb') as fp:
+                return self.read_header(fp)[1] > time.time()
+        except (FileNotFoundError, ValueError):
+            return False
+
+    def __getitem__(self, url):
+        """Load value at this URL."""
+        path = self.path(self.key(url))
+        try:
+            with open(path, 'rb') as fp:
+                codec_id, expires = self.read_header(fp)
+                if expires <= time.time():
+                    raise KeyError(url + ' does not exist')
+                offset = fp.tell()
+                if os.fstat(fp.fileno()).st_size < self.mmap_threshold:
+                    return self.codec.decode(codec_id, fp.read())
+                with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+                        memoryview(mm) as view, view[offset:] as data:
+                    return self.codec.decode(codec_id, data)
+        except (FileNotFoundError, ValueError):
+            raise KeyError(url + ' does not exist')
+
+    def __setitem__(self, url, result):
+        """Save value for this URL, readers never see a partial file."""
+        key = self.key(url)
+        path = self.path(key)
+        dirname = os.path.dirname(path)
+        os.makedirs(dirname, exist_ok=True)
+
+        codec_id, data = self.codec.encode(result)
+        expires = time.time() + self.expires.total_seconds()
+        fd, tmp = tempfile.mkstemp(dir=dirname)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(('%s %f\n' % (codec_id, expires)).encode('ascii'))
+                fp.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        # a single short write in append mode does not interleave between processes
+        with open(self.index, 'a') as fp:
+            fp.write('%f %s\n' % (expires, key))
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def purge(self):
+        """Remove expired entries and compact the index, return their number."""
+        now = time.time()
+        latest = {}
+        try:
+            with open(self.index) as fp:
+                for line in fp:
+                    expires, key = line.split()
+                    latest[key] = max(float(expires), latest.get(key, 0))
+                offset = fp.tell()
+        except FileNotFoundError:
+            return 0
+
+        removed = 0
+        for key, expires in list(latest.items()):
+            if expires > now:
+                continue
+            del latest[key]
+            path = self.path(key)
+            try:
+                with open(path, 'rb') as fp:
+                    expires = self.read_header(fp)[1]
+                if expires > now:
+                    # rewritten by another process since the index was read
+                    latest[key] = expires
+                    continue
+                os.unlink(path)
+                removed += 1
+            except (FileNotFoundError, ValueError):
+                pass
+
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir)
+        with os.fdopen(fd, 'w') as fp:
+            for key, expires in latest.items():
+                fp.write('%f %s\n' % (expires, key))
+            # keep what was appended while purging
+            with open(self.index) as index:
+                index.seek(offset)
+                fp.write(index.read())
+        os.replace(tmp, self.index)
+        return removed
+
+    def clear(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        os.makedirs(self.cache_dir, exist_ok=True)
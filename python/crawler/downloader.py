@@ -4,32 +4,87 @@
 Provide download function by request
 """
 
-from datetime import datetime
+from collections import OrderedDict
+from concurrent import futures
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+import hashlib
 import logging
+import os
+import shutil
+import tempfile
+import threading
 import time
 import urllib.parse
 
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+
+from metrics import Metrics
+from retry import RetryPolicy, parse_http_date
+from robots import RobotsCache
+
+
+# exceptions retried unless the RetryPolicy names its own
+RETRY_EXCEPTIONS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
 
 
 class Throttle(object):
-    """Throttle downloading by sleeping between requests to same domain."""
-    def __init__(self, delay):
+    """Throttle downloading by sleeping between requests to same domain.
+
+    At most `max_domains` domains are remembered, least recently used
+    first forgotten, with their own delay if they set one.
+    """
+    def __init__(self, delay, max_domains=10000):
         # amount of delay between downloads for each domain
         self.delay = delay
-        # timestamp of when a domain was last accessed
-        self.domains = {}
+        self.max_domains = max_domains
+        # domain -> [monotonic timestamp of its next download slot or None,
+        # its own delay or None], e.g. set by Crawl-delay
+        self.domains = OrderedDict()
+        self.lock = threading.Lock()
+
+    def entry(self, domain):
+        # called under the lock
+        entry = self.domains.get(domain)
+        if entry is None:
+            entry = self.domains[domain] = [None, None]
+            if len(self.domains) > self.max_domains:
+                self.domains.popitem(last=False)
+        else:
+            self.domains.move_to_end(domain)
+        return entry
+
+    def set_delay(self, domain, delay):
+        """Use delay between downloads from domain instead of the default."""
+        with self.lock:
+            self.entry(domain)[1] = delay
 
     def wait(self, url):
+        sleep_secs = self.reserve(url)
+        if sleep_secs > 0:
+            time.sleep(sleep_secs)
+
+    def reserve(self, url):
+        """Book the next download slot for the domain of url.
+
+        Return the number of seconds the caller has to wait before
+        downloading, without sleeping, so that asynchronous callers
+        can wait in their own way.
+        """
         domain = urllib.parse.urlparse(url).netloc
-        last_accessed = self.domains.get(domain)
+        with self.lock:
+            entry = self.entry(domain)
+            last_accessed, delay = entry
+            now = time.monotonic()
 
-        if self.delay > 0 and last_accessed is not None:
-            sleep_secs = self.delay - (datetime.now() - last_accessed).seconds
-            if sleep_secs > 0:
-                time.sleep(sleep_secs)
-        self.domains[domain] = datetime.now()
+            if delay is None:
+                delay = self.delay
+            sleep_secs = 0
+            if delay > 0 and last_accessed is not None:
+                sleep_secs = max(delay - (now - last_accessed), 0)
+            entry[0] = now + sleep_secs
+        return sleep_secs
 
 
 class Downloader(object):
@@ -39,17 +94,39 @@ class Downloader(object):
         delay: Interval between downloads (seconds)
         num_retries: Number of retries when downloading errors
         timeout: Download timeout
+        retry: retry.RetryPolicy used instead of RetryPolicy(num_retries),
+            its breaker is shared by the threads of the downloader
+        throttle: Object with a `wait(url)` method used instead of
+            Throttle(delay), e.g. scheduler.DomainScheduler
+        pool_connections: Number of hosts whose connections are kept
+        pool_maxsize: Number of keep-alive connections kept per host,
+            should be at least the number of threads used by fetch_many
+        max_age: Seconds after which a cached page is revalidated with a
+            conditional GET, None to always trust the cache
+        robots: True to obey robots.txt, or a robots.RobotsCache to share
+        metrics: metrics.Metrics collecting the counters and timings of the
+            downloads per domain, a new one by default
     """
     def __init__(self, delay=5, user_agent='awsl', proxies=None, num_retries=1,
-                 timeout=60, cache=None, auth=None):
+                 timeout=60, cache=None, auth=None, throttle=None,
+                 pool_connections=10, pool_maxsize=10, max_age=None, robots=None,
+                 retry=None, metrics=None):
         self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections,
+                              pool_maxsize=pool_maxsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
         self.session.headers.update({'user-agent': user_agent})
         self.session.proxies = proxies
         self.session.auth = auth
-        self.throttle = Throttle(delay)
-        self.num_retries = num_retries
+        self.throttle = Throttle(delay) if throttle is None else throttle
+        self.retry = RetryPolicy(num_retries) if retry is None else retry
+        self.num_retries = self.retry.num_retries
         self.timeout = timeout
         self.cache = cache
+        self.max_age = max_age
+        self.robots = RobotsCache(self) if robots is True else robots or None
+        self.metrics = Metrics() if metrics is None else metrics
 
     def get_from_cache(self, request):
         """Try to get the result of the request from the cache."""
@@ -58,51 +135,280 @@ class Downloader(object):
             result = self.cache.get(request.url)
             if result and self.num_retries > 0 and 500 <= result['code'] < 600:
                 result = None
+            domain = urllib.parse.urlparse(request.url).netloc
+            self.metrics.inc('cache_misses' if result is None else 'cache_hits', domain)
         return result
 
+    def is_stale(self, result):
+        """Whether a cached result has to be revalidated."""
+        if self.max_age is None:
+            return False
+        fetched = result.get('fetched')
+        return fetched is None or datetime.utcnow() - fetched > timedelta(seconds=self.max_age)
+
+    def add_validators(self, request, result):
+        """Turn request into a conditional GET for the cached result."""
+        if result.get('etag'):
+            request.headers['If-None-Match'] = result['etag']
+        if result.get('last_modified'):
+            request.headers['If-Modified-Since'] = format_datetime(
+                result['last_modified'].replace(tzinfo=timezone.utc), usegmt=True)
+
+    def validators(self, response):
+        """Return the cache validators sent with response."""
+        validators = {}
+        if 'ETag' in response.headers:
+            validators['etag'] = response.headers['ETag']
+        if 'Last-Modified' in response.headers:
+            last_modified = parse_http_date(response.headers['Last-Modified'])
+            if last_modified:
+                validators['last_modified'] = last_modified
+        return validators
+
     def prepare_request(self, url, params=None):
         """Build requests based on the provided url and parameters."""
         request = requests.Request('GET', url, params=params)
         return self.session.prepare_request(request)
 
-    def send_request(self, request, num_retries):
-        """Send request and return response object."""
-        self.throttle.wait(request.url)
-        try:
-            logging.info('Downloading: %s' % request.url)
-            response = self.session.send(request, timeout=self.timeout)
-            response.raise_for_status()
-        except requests.exceptions.HTTPError as e:
-            logging.warn('Download error: %s' % e)
-            if num_retries > 0 and 500 <= response.status_code < 600:
-                return self.send_request(request, num_retries - 1)
-        except requests.exceptions.RequestException:
-            logging.error('Download faild: %s' % request.url)
+    def send_request(self, request, num_retries, stream=False):
+        """Send request and return response object.
+
+        With stream the body is not read, see `iter_content`. Failures
+        are retried up to num_retries times as the retry policy says, the
+        last error response is returned. Return None if the download
+        failed without a response, the circuit of the host is open or
+        robots.txt disallows the url.
+        """
+        metrics = self.metrics
+        host = urllib.parse.urlparse(request.url).netloc
+        if self.robots is not None and not self.robots.can_fetch(request.url):
+            logging.info('Blocked by robots.txt: %s' % request.url)
+            metrics.inc('robots_blocked', host)
+            return None
+        retry = self.retry
+        exceptions = retry.exceptions or RETRY_EXCEPTIONS
+        attempt = 0
+        while True:
+            if not retry.allow(host):
+                logging.warning('Host is failing, skipped: %s' % request.url)
+                metrics.inc('circuit_open', host)
+                return None
+            start = time.monotonic()
+            self.throttle.wait(request.url)
+            sent = time.monotonic()
+            metrics.observe('throttle_seconds', sent - start, host)
+            metrics.inc('requests', host)
             response = None
-        return response
+            try:
+                logging.info('Downloading: %s' % request.url)
+                response = self.session.send(request, timeout=self.timeout, stream=stream)
+            except exceptions as e:
+                logging.warning('Download error: %s' % e)
+                metrics.inc('errors', host)
+            except requests.exceptions.RequestException:
+                logging.error('Download faild: %s' % request.url)
+                metrics.inc('errors', host)
+                return None
+            else:
+                # requests measures the time until the headers are parsed
+                metrics.observe('ttfb_seconds', response.elapsed.total_seconds(), host)
+                if not stream:
+                    metrics.observe('request_seconds', time.monotonic() - sent, host)
+                    metrics.inc('bytes', host, len(response.content))
+                metrics.inc('responses_%dxx' % (response.status_code // 100), host)
+                if response.status_code >= 400:
+                    logging.warning('Download error: %s %s' % (response.status_code, request.url))
+                if not retry.retry_status(response.status_code):
+                    retry.success(host)
+                    return response
+            retry.failure(host)
+
+            delay = None
+            if attempt < num_retries:
+                retry_after = response.headers.get('Retry-After') if response is not None else None
+                delay = retry.delay(attempt, retry_after)
+            if delay is None:
+                if response is None:
+                    logging.error('Download faild: %s' % request.url)
+                return response
+            if response is not None:
+                response.close()
+            metrics.inc('retries', host)
+            time.sleep(delay)
+            attempt += 1
+
+    def fetch(self, url, params=None, encoding=None, kind='text'):
+        """Download url and return the result dict, None if it failed.
+
+        A stale cached result is revalidated with If-None-Match and
+        If-Modified-Since, a 304 answer is served from the cache and so is
+        a failed revalidation.
+        """
+        request = self.prepare_request(url, params)
+        cached = self.get_from_cache(request)
+        if cached is not None and kind in cached:
+            if not self.is_stale(cached):
+                return cached
+            self.add_validators(request, cached)
+        else:
+            cached = None
+
+        response = self.send_request(request, self.num_retries)
+        if not response:
+            return cached
+        if response.status_code == 304 and cached is not None:
+            result = dict(cached, **self.validators(response))
+        else:
+            if encoding:
+                response.encoding = encoding
+            try:
+                body = response.json() if kind == 'json' else response.text
+            except ValueError:
+                # not JSON, a failure as in AsyncDownloader
+                logging.error('Download faild: %s' % request.url)
+                return cached
+            result = {kind: body, 'code': response.status_code}
+            result.update(self.validators(response))
+        result['fetched'] = datetime.utcnow()
+        if self.cache:
+            self.cache[request.url] = result
+        return result
 
     def text(self, url, params=None, encoding=None):
         """Download web content in text format or html."""
-        request = self.prepare_request(url, params)
-        result = self.get_from_cache(request)
-        if result is None:
-            response = self.send_request(request, self.num_retries)
-            if response:
-                if encoding:
-                    response.encoding = encoding
-                result = {'text': response.text, 'code': response.status_code}
-                if self.cache:
-                    self.cache[request.url] = result
-        return result['text']
+        result = self.fetch(url, params, encoding, 'text')
+        return result['text'] if result else None
 
     def json(self, url, params=None):
         """Access the api and return the json object."""
+        result = self.fetch(url, params, kind='json')
+        return result['json'] if result else None
+
+    def fetch_many(self, urls, max_workers=8, kind='text'):
+        """Download urls with a thread pool, yield (url, text or json) pairs
+        in completion order. The value is None when the download failed.
+
+        At most 2 * max_workers downloads are queued at once, so urls can
+        be a long lazy iterable.
+        """
+        fetch = self.json if kind == 'json' else self.text
+        urls = iter(urls)
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = {}
+            while True:
+                for url in urls:
+                    pending[executor.submit(fetch, url)] = url
+                    if len(pending) >= 2 * max_workers:
+                        break
+                if not pending:
+                    break
+                done, _ = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    url = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception:
+                        # one failed download must not end the batch
+                        logging.exception('Download faild: %s' % url)
+                        result = None
+                    yield url, result
+
+    def iter_content(self, url, params=None, chunk_size=64 * 1024):
+        """Download url and yield the body in chunks of bytes, without
+        holding the whole body in memory. Nothing is cached.
+        """
+        request = self.prepare_request(url, params)
+        response = self.send_request(request, self.num_retries, stream=True)
+        if response is None:
+            return
+        with response:
+            for chunk in response.iter_content(chunk_size):
+                yield chunk
+
+    def stream(self, url, sink=None, params=None, chunk_size=64 * 1024,
+               checksum=None, spool_size=8 * 1024 * 1024):
+        """Download url chunk by chunk into sink.
+
+        Args:
+            sink: Path of the file to write, a writable binary file object,
+                or None for a temporary file kept in memory up to
+                spool_size bytes and spilled to disk beyond it
+            checksum: Name of a hashlib algorithm computed on the fly,
+                e.g. 'sha256'
+
+        Return:
+            Result dict with 'file' (the path or file object), 'size', 'code'
+            and the hex digest under the checksum name, None if it failed.
+            Only downloads to a path are cached, as a reference to the file.
+        """
         request = self.prepare_request(url, params)
         result = self.get_from_cache(request)
-        if result is None:
-            response = self.send_request(request, self.num_retries)
-            if response:
-                result = {'json': response.json(), 'code': response.status_code}
-                if self.cache:
-                    self.cache[request.url] = result
-        return result['json']
+        if result is not None and 'file' in result and os.path.exists(result['file']):
+            return self.copy_cached(result, sink)
+
+        response = self.send_request(request, self.num_retries, stream=True)
+        if response is None:
+            return None
+        if not response:
+            # an error status, give the unread connection back to the pool
+            response.close()
+            return None
+
+        digest = hashlib.new(checksum) if checksum else None
+        if sink is None:
+            fp = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        elif isinstance(sink, str):
+            # write next to the target and rename, never leave half a file
+            fp = tempfile.NamedTemporaryFile(
+                dir=os.path.dirname(os.path.abspath(sink)), delete=False)
+        else:
+            fp = sink
+
+        size = 0
+        start = time.monotonic()
+        domain = urllib.parse.urlparse(request.url).netloc
+        try:
+            with response:
+                for chunk in response.iter_content(chunk_size):
+                    fp.write(chunk)
+                    size += len(chunk)
+                    if digest:
+                        digest.update(chunk)
+        except requests.exceptions.RequestException:
+            logging.error('Download faild: %s' % request.url)
+            self.metrics.inc('errors', domain)
+            if isinstance(sink, str):
+                fp.close()
+                os.unlink(fp.name)
+            return None
+        self.metrics.observe(
+            'request_seconds', response.elapsed.total_seconds() + time.monotonic() - start, domain)
+        self.metrics.inc('bytes', domain, size)
+
+        result = {'file': sink, 'size': size, 'code': response.status_code}
+        if digest:
+            result[checksum] = digest.hexdigest()
+        if sink is None:
+            fp.seek(0)
+            result['file'] = fp
+        elif isinstance(sink, str):
+            fp.close()
+            os.replace(fp.name, sink)
+            if self.cache:
+                self.cache[request.url] = result
+        return result
+
+    def copy_cached(self, result, sink):
+        """Deliver a cached file download to sink like `stream` would."""
+        result = dict(result)
+        if sink is None:
+            result['file'] = open(result['file'], 'rb')
+        elif isinstance(sink, str):
+            if os.path.abspath(sink) != os.path.abspath(result['file']):
+                shutil.copyfile(result['file'], sink)
+            result['file'] = sink
+        else:
+            with open(result['file'], 'rb') as fp:
+                shutil.copyfileobj(fp, sink)
+            result['file'] = sink
+        return result
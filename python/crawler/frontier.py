@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+"""
+Crawl frontier with priorities and fair scheduling between domains
+"""
+
+import heapq
+import itertools
+import queue
+import threading
+import time
+import urllib.parse
+
+from scheduler import DomainScheduler
+
+
+class Frontier(object):
+    """In-memory frontier which only hands out URLs that can be fetched now.
+
+    URLs of a domain come out by priority, highest first, then in the
+    order they were put. Domains take turns as the scheduler allows them,
+    a slow or throttled domain does not hold the others back.
+
+    It has the interface of queue.Queue, so it can replace one in the
+    crawlers. The scheduler books the download slot when a URL is handed
+    out, so the downloader should not throttle again, e.g. Downloader(delay=0).
+
+    >>> frontier = Frontier(delay=60)
+    >>> for url in ['http://a.com/1', 'http://a.com/2', 'http://b.com/1']:
+    ...     frontier.put(url)
+    >>> frontier.put('http://a.com/urgent', priority=10)
+    >>> sorted([frontier.get(), frontier.get()])
+    ['http://a.com/urgent', 'http://b.com/1']
+    >>> try:
+    ...     frontier.get(timeout=0.1)
+    ... except queue.Empty:
+    ...     print('nothing ready')
+    nothing ready
+    >>> len(frontier)
+    2
+    """
+    def __init__(self, delay=5, scheduler=None):
+        self.scheduler = DomainScheduler(delay) if scheduler is None else scheduler
+        # domain -> heap of (-priority, sequence, url)
+        self.domains = {}
+        self.counter = itertools.count()
+        self.size = 0
+        self.unfinished_tasks = 0
+        self.condition = threading.Condition()
+        self.all_tasks_done = threading.Condition(self.condition)
+
+    def put(self, url, priority=0, block=True, timeout=None):
+        domain = urllib.parse.urlparse(url).netloc
+        with self.condition:
+            heapq.heappush(self.domains.setdefault(domain, []),
+                           (-priority, next(self.counter), url))
+            self.size += 1
+            self.unfinished_tasks += 1
+            self.scheduler.push(domain)
+            self.condition.notify()
+
+    def get(self, block=True, timeout=None):
+        """Remove and return a URL whose domain can be downloaded now.
+
+        Raise queue.Empty if none becomes ready within timeout, or at once
+        if block is false.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while True:
+                domain = self.scheduler.pop()
+                if domain is not None:
+                    urls = self.domains[domain]
+                    url = heapq.heappop(urls)[2]
+                    if urls:
+                        self.scheduler.push(domain)
+                    else:
+                        del self.domains[domain]
+                    self.size -= 1
+                    return url
+
+                if not block:
+                    raise queue.Empty
+                # sleep until the next domain is ready or a URL is put
+                wait = None
+                upcoming = self.scheduler.next_ready()
+                if upcoming is not None:
+                    wait = upcoming[1]
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise queue.Empty
+                    wait = remaining if wait is None else min(wait, remaining)
+                self.condition.wait(wait)
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def task_done(self):
+        with self.condition:
+            if self.unfinished_tasks <= 0:
+                raise ValueError('task_done() called too many times')
+            self.unfinished_tasks -= 1
+            if not self.unfinished_tasks:
+                self.all_tasks_done.notify_all()
+
+    def join(self):
+        with self.all_tasks_done:
+            while self.unfinished_tasks:
+                self.all_tasks_done.wait()
+
+    def qsize(self):
+        return self.size
+
+    __len__ = qsize
+
+    def empty(self):
+        return not self.size
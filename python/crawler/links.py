@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+"""
+Extract the links of html pages without building a document tree
+"""
+
+import concurrent.futures
+import html.parser
+import urllib.parse
+
+try:
+    from lxml import etree
+except ImportError:
+    etree = None
+
+
+# attributes holding links, by tag
+LINK_ATTRIBUTES = {
+    'a': 'href', 'area': 'href', 'link': 'href',
+    'img': 'src', 'script': 'src', 'iframe': 'src', 'frame': 'src',
+    'embed': 'src', 'source': 'src', 'audio': 'src', 'video': 'src',
+}
+
+SKIPPED_SCHEMES = ('javascript:', 'mailto:', 'tel:', 'data:')
+
+
+class LinkTarget(object):
+    """Parser target of lxml, only start tags are looked at."""
+    def __init__(self):
+        self.base = None
+        self.links = []
+
+    def start(self, tag, attrib):
+        name = LINK_ATTRIBUTES.get(tag)
+        if name:
+            value = attrib.get(name)
+            if value:
+                self.links.append(value)
+        elif tag == 'base' and self.base is None:
+            self.base = attrib.get('href')
+
+    def end(self, tag):
+        pass
+
+    def data(self, data):
+        pass
+
+    def close(self):
+        return self
+
+
+class LinkParser(html.parser.HTMLParser):
+    """Fallback of LinkTarget on the standard library parser."""
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.base = None
+        self.links = []
+
+    def handle_starttag(self, tag, attrs):
+        name = LINK_ATTRIBUTES.get(tag)
+        if name:
+            for key, value in attrs:
+                if key == name and value:
+                    self.links.append(value)
+                    break
+        elif tag == 'base' and self.base is None:
+            self.base = dict(attrs).get('href')
+
+    handle_startendtag = handle_starttag
+
+
+def parse_links(text, parser=None):
+    """Return the base href and the raw links of a page.
+
+    parser: 'lxml' or 'html.parser', the first available by default
+    """
+    if parser is None:
+        parser = 'lxml' if etree is not None else 'html.parser'
+    if parser == 'lxml':
+        target = LinkTarget()
+        p = etree.HTMLParser(target=target, recover=True)
+        p.feed(text)
+        p.close()
+    else:
+        target = LinkParser()
+        target.feed(text)
+        target.close()
+    return target.base, target.links
+
+
+def resolve_links(base_url, links):
+    """Make links absolute, dropping fragments, duplicates and non http links.
+
+    Only the links which are not plain absolute or root relative go
+    through urljoin, the base is split once for all of them.
+
+    >>> resolve_links('http://example.com/a/b', ['c', '/d#x', 'http://x.org/', 'mailto:me', '/d'])
+    ['http://example.com/a/c', 'http://example.com/d', 'http://x.org/']
+    """
+    parts = urllib.parse.urlsplit(base_url)
+    origin = '%s://%s' % (parts.scheme, parts.netloc)
+    seen = set()
+    result = []
+    for link in links:
+        link = link.strip()
+        if link.startswith(('http://', 'https://')):
+            url = link
+        elif link.startswith('/') and not link.startswith('//'):
+            url = origin + link
+        elif link.lower().startswith(SKIPPED_SCHEMES):
+            continue
+        else:
+            url = urllib.parse.urljoin(base_url, link)
+            if not url.startswith(('http://', 'https://')):
+                continue
+        if '#' in url:
+            url = url.split('#', 1)[0]
+        if url not in seen:
+            seen.add(url)
+            result.append(url)
+    return result
+
+
+def extract_links(url, text, parser=None):
+    """Absolute links of the page at url.
+
+    >>> extract_links('http://example.com/a/', '<a href="b">b</a><img src="/c.png">')
+    ['http://example.com/a/b', 'http://example.com/c.png']
+    >>> extract_links('http://example.com/', '<base href="http://cdn.com/"><a href="b">', 'html.parser')
+    ['http://cdn.com/b']
+    """
+    base, links = parse_links(text, parser)
+    if base:
+        base = urllib.parse.urljoin(url, base)
+    return resolve_links(base or url, links)
+
+
+def extract_page(page):
+    return page[0], extract_links(*page)
+
+
+class LinkExtractor(object):
+    """Extract links in worker processes, away from the I/O threads.
+
+    >>> with LinkExtractor(max_workers=2) as extractor:
+    ...     list(extractor.map([('http://example.com/', '<a href="a">a</a>')]))
+    [('http://example.com/', ['http://example.com/a'])]
+
+    Args:
+        max_workers: Number of processes, the number of CPUs by default
+        parser: Passed to parse_links
+    """
+    def __init__(self, max_workers=None, parser=None):
+        self.parser = parser
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers)
+
+    def submit(self, url, text):
+        """Return a future of the links of the page at url."""
+        return self.executor.submit(extract_links, url, text, self.parser)
+
+    def map(self, pages, chunksize=16):
+        """Yield (url, links) for every (url, text) of pages, in order."""
+        if self.parser is None:
+            return self.executor.map(extract_page, pages, chunksize=chunksize)
+        pages = ((url, text, self.parser) for url, text in pages)
+        return self.executor.map(extract_page, pages, chunksize=chunksize)
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
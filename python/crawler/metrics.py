@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+
+"""
+Counters and latency histograms of a crawl, per domain
+"""
+
+import bisect
+import json
+import logging
+import threading
+import time
+
+
+# upper bounds of the histogram buckets, in seconds or bytes
+SECONDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1, 2.5, 5, 10, 30, 60, float('inf'))
+BYTES = tuple(2 ** i for i in range(8, 27, 2)) + (float('inf'),)
+
+
+class Histogram(object):
+    """Counts of observations in fixed buckets, O(log buckets) to update.
+
+    >>> h = Histogram()
+    >>> for value in (0.002, 0.02, 0.2, 2):
+    ...     h.observe(value)
+    >>> h.count, h.quantile(0.5), h.quantile(1)
+    (4, 0.025, 2.5)
+    """
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds=SECONDS):
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.sum += other.sum
+        self.count += other.count
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q quantile."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return self.bounds[-1]
+
+    def copy(self):
+        h = Histogram(self.bounds)
+        h.merge(self)
+        return h
+
+
+class Metrics(object):
+    """Counters and histograms keyed by name and domain, shared by threads.
+
+    Updates are a dict lookup under one lock, cheap enough to stay on in
+    production. Histograms whose name ends with `_bytes` use byte buckets.
+    More than `max_domains` domains are counted together as 'other'.
+
+    >>> metrics = Metrics()
+    >>> metrics.inc('requests', 'a.com'); metrics.inc('requests', 'b.com', 2)
+    >>> metrics.observe('request_seconds', 0.3, 'a.com')
+    >>> metrics.total('requests'), metrics.histogram('request_seconds').count
+    (3, 1)
+    >>> print(metrics.prometheus().splitlines()[1])
+    crawler_requests_total{domain="a.com"} 1
+    """
+    def __init__(self, max_domains=1000, prefix='crawler_'):
+        self.max_domains = max_domains
+        self.prefix = prefix
+        # (name, domain) -> value or Histogram
+        self.counters = {}
+        self.histograms = {}
+        self.domains = set()
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stopped = threading.Event()
+        self.reporter = None
+
+    def label(self, domain):
+        # called under the lock
+        if not domain or domain in self.domains:
+            return domain
+        if len(self.domains) < self.max_domains:
+            self.domains.add(domain)
+            return domain
+        return 'other'
+
+    def inc(self, name, domain='', value=1):
+        with self.lock:
+            key = (name, self.label(domain))
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, domain=''):
+        with self.lock:
+            key = (name, self.label(domain))
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                bounds = BYTES if name.endswith('_bytes') else SECONDS
+                histogram = self.histograms[key] = Histogram(bounds)
+            histogram.observe(value)
+
+    def total(self, name):
+        """Value of counter name summed over the domains."""
+        with self.lock:
+            return sum(value for (n, _), value in self.counters.items() if n == name)
+
+    def histogram(self, name):
+        """Histogram name merged over the domains."""
+        with self.lock:
+            merged = None
+            for (n, _), histogram in self.histograms.items():
+                if n == name:
+                    if merged is None:
+                        merged = Histogram(histogram.bounds)
+                    merged.merge(histogram)
+            return merged if merged is not None else Histogram()
+
+    def snapshot(self):
+        """Copy of the data, picklable to be merged in another process."""
+        with self.lock:
+            return {'counters': dict(self.counters),
+                    'histograms': {key: h.copy() for key, h in self.histograms.items()}}
+
+    def merge(self, snapshot):
+        """Add the data of a snapshot, e.g. of a crawler process."""
+        with self.lock:
+            for (name, domain), value in snapshot['counters'].items():
+                key = (name, self.label(domain))
+                self.counters[key] = self.counters.get(key, 0) + value
+            for (name, domain), histogram in snapshot['histograms'].items():
+                key = (name, self.label(domain))
+                if key in self.histograms:
+                    self.histograms[key].merge(histogram)
+                else:
+                    self.histograms[key] = histogram.copy()
+
+    def prometheus(self):
+        """Dump in the Prometheus text exposition format.
+
+        >>> metrics = Metrics()
+        >>> metrics.observe('item_seconds', 0.3)
+        >>> print(metrics.prometheus().splitlines()[-1])
+        crawler_item_seconds_count{domain=""} 1
+        """
+        snapshot = self.snapshot()
+        lines = []
+        for (name, domain), value in sorted(snapshot['counters'].items()):
+            metric = self.prefix + name + '_total'
+            if not lines or not lines[-1].startswith(metric + '{'):
+                lines.append('# TYPE %s counter' % metric)
+            lines.append('%s{domain="%s"} %s' % (metric, escape(domain), value))
+        for (name, domain), histogram in sorted(snapshot['histograms'].items()):
+            metric = self.prefix + name
+            if not lines or lines[-1].split('{')[0] != metric + '_count':
+                lines.append('# TYPE %s histogram' % metric)
+            label = 'domain="%s"' % escape(domain)
+            total = 0
+            for bound, count in zip(histogram.bounds, histogram.counts):
+                total += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('%s_bucket{%s,le="%s"} %d' % (metric, label, le, total))
+            lines.append('%s_sum{%s} %r' % (metric, label, histogram.sum))
+            lines.append('%s_count{%s} %d' % (metric, label, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def json_lines(self):
+        """One JSON document per counter and histogram."""
+        snapshot = self.snapshot()
+        now = time.time()
+        for (name, domain), value in sorted(snapshot['counters'].items()):
+            yield json.dumps({'time': now, 'name': name, 'domain': domain, 'value': value})
+        for (name, domain), histogram in sorted(snapshot['histograms'].items()):
+            yield json.dumps({
+                'time': now, 'name': name, 'domain': domain,
+                'count': histogram.count, 'sum': histogram.sum,
+                'p50': histogram.quantile(0.5), 'p95': histogram.quantile(0.95),
+                'p99': histogram.quantile(0.99)})
+
+    def summary(self):
+        """One line of the totals of the crawl."""
+        requests = self.total('requests')
+        hits, misses = self.total('cache_hits'), self.total('cache_misses')
+        latency = self.histogram('request_seconds')
+        elapsed = time.time() - self.started
+        return ('%d requests, %.1f req/s, %d errors, %d retries, %.1f MB, '
+                'cache hit rate %.0f%%, latency p50 %gs p95 %gs, throttle wait %.1fs' % (
+                    requests, requests / elapsed if elapsed else 0.0,
+                    self.total('errors'), self.total('retries'), self.total('bytes') / 1e6,
+                    100.0 * hits / (hits + misses) if hits + misses else 0.0,
+                    latency.quantile(0.5), latency.quantile(0.95),
+                    self.histogram('throttle_seconds').sum))
+
+    def report(self, interval=10, path=None):
+        """Log the summary every interval seconds until closed, and append
+        the metrics as JSON lines to the file at path if given.
+        """
+        def run():
+            while not self.stopped.wait(interval):
+                logging.info(self.summary())
+                if path:
+                    with open(path, 'a') as fp:
+                        for line in self.json_lines():
+                            fp.write(line + '\n')
+        self.reporter = threading.Thread(target=run, daemon=True)
+        self.reporter.start()
+
+    def close(self):
+        """Stop the reporter."""
+        self.stopped.set()
+        if self.reporter is not None:
+            self.reporter.join()
+            self.reporter = None
+
+
+def escape(value):
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
@@ -4,17 +4,16 @@
 Cache support via MongoDB database
 """
 
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
-
-import zlib
+import logging
+import threading
+import time
 from datetime import datetime, timedelta
 
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
 from bson.binary import Binary
 
+from codec import Codec
+
 
 class MongoCache(object):
     """
@@ -36,40 +35,65 @@ class MongoCache(object):
      ...
     KeyError: 'http://example.webscraping.com does not exist'
     """
-    def __init__(self, client=None, expires=timedelta(days=30)):
+    def __init__(self, client=None, expires=timedelta(days=30), codec=None):
         """
         client: mongo database client
         expires: timedelta of amount of time before a cache entry is considered expired
+        codec: codec.Codec used to store values, pickle and zlib by default,
+               entries keep decoding after it changed
         """
         # if a client object is not passed
         # then try connecting to mongodb at the default localhost port
         self.client = MongoClient('localhost', 27017) if client is None else client
+        self.expires = expires
+        self.codec = Codec() if codec is None else codec
         # create collection to store cached webpages,
         # which is the equivalent of a table in a relational database
         self.db = self.client.cache
         self.db.webpage.create_index('timestamp', expireAfterSeconds=expires.total_seconds())
 
     def __contains__(self, url):
-        try:
-            self[url]
-        except KeyError:
-            return False
-        else:
-            return True
+        # only fetch the key, not the compressed result
+        return self.db.webpage.find_one({'_id': url}, projection={'_id': True}) is not None
 
     def __getitem__(self, url):
         """Load value at this URL."""
+        return self.fetch(url)[0]
+
+    def fetch(self, url):
+        """Load value at this URL and the time.time() it expires at."""
         record = self.db.webpage.find_one({'_id': url})
         if record:
-            # return record['result']
-            return pickle.loads(zlib.decompress(record['result']))
+            stored = (record['timestamp'] - datetime(1970, 1, 1)).total_seconds()
+            return self.decode(record), stored + self.expires.total_seconds()
         else:
             raise KeyError(url + ' does not exist')
 
     def __setitem__(self, url, result):
         """Save value for this URL."""
-        record = {'result': Binary(zlib.compress(pickle.dumps(result))), 'timestamp': datetime.utcnow()}
-        self.db.webpage.update({'_id': url}, {'$set': record}, upsert=True)
+        self.db.webpage.update_one({'_id': url}, {'$set': self.encode(result)}, upsert=True)
+
+    def encode(self, result):
+        codec_id, data = self.codec.encode(result)
+        return {'result': Binary(data), 'codec': codec_id, 'timestamp': datetime.utcnow()}
+
+    def decode(self, record):
+        # records written before codecs were recorded have none
+        return self.codec.decode(record.get('codec'), record['result'])
+
+    def get_many(self, urls):
+        """Load the values of urls with one query, return a dict of the
+        urls which exist.
+        """
+        records = self.db.webpage.find({'_id': {'$in': list(urls)}})
+        return {record['_id']: self.decode(record) for record in records}
+
+    def set_many(self, mapping):
+        """Save a dict of url -> value with one unordered bulk write."""
+        requests = [UpdateOne({'_id': url}, {'$set': self.encode(result)}, upsert=True)
+                    for url, result in mapping.items()]
+        if requests:
+            self.db.webpage.bulk_write(requests, ordered=False)
 
     def get(self, key, default=None):
         try:
@@ -79,3 +103,114 @@ class MongoCache(object):
 
     def clear(self):
         self.db.webpage.drop()
+
+
+class WriteBehindCache(object):
+    """
+    Buffer writes to a cache with `set_many` and flush them in the background
+
+    Pending writes are flushed when `max_items` of them are buffered or
+    `max_delay` seconds after the first one, reads see pending writes.
+    A failed flush is retried after `max_delay` seconds. Call `close()`
+    to flush what is left.
+
+    >>> cache = WriteBehindCache(MongoCache(), max_items=100, max_delay=1)
+    >>> cache['http://example.webscraping.com'] = {'html': '...'}
+    >>> cache.close()
+    """
+    def __init__(self, cache, max_items=100, max_delay=1.0):
+        self.cache = cache
+        self.max_items = max_items
+        self.max_delay = max_delay
+        self.pending = {}
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __contains__(self, url):
+        with self.condition:
+            if url in self.pending:
+                return True
+        return url in self.cache
+
+    def __getitem__(self, url):
+        with self.condition:
+            if url in self.pending:
+                return self.pending[url]
+        return self.cache[url]
+
+    def __setitem__(self, url, result):
+        with self.condition:
+            if self.closed:
+                raise ValueError('write to closed cache')
+            self.pending[url] = result
+            if len(self.pending) == 1 or len(self.pending) >= self.max_items:
+                self.condition.notify()
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def get_many(self, urls):
+        urls = list(urls)
+        with self.condition:
+            found = {url: self.pending[url] for url in urls if url in self.pending}
+        found.update(self.cache.get_many([url for url in urls if url not in found]))
+        return found
+
+    def set_many(self, mapping):
+        for url, result in mapping.items():
+            self[url] = result
+
+    def run(self):
+        closed = failed = False
+        while not closed:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if failed:
+                    # back off, new writes must not retry a down cache at once
+                    deadline = time.monotonic() + self.max_delay
+                    while not self.closed and time.monotonic() < deadline:
+                        self.condition.wait(deadline - time.monotonic())
+                elif not self.closed and len(self.pending) < self.max_items:
+                    self.condition.wait(self.max_delay)
+                closed = self.closed
+            try:
+                self.flush()
+                failed = False
+            except Exception:
+                # keep the values pending, they are retried on the next flush
+                logging.exception('Cache flush failed')
+                failed = True
+
+    def flush(self):
+        """Write the pending values now."""
+        with self.condition:
+            batch = dict(self.pending)
+        if batch:
+            self.cache.set_many(batch)
+            with self.condition:
+                # values written again meanwhile stay pending
+                for url, result in batch.items():
+                    if self.pending.get(url) is result:
+                        del self.pending[url]
+
+    def close(self):
+        """Flush the pending writes, log the ones which could not be."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+        with self.condition:
+            dropped = len(self.pending)
+        if dropped:
+            logging.error('Cache closed with %d writes not flushed' % dropped)
+
+    def clear(self):
+        with self.condition:
+            self.pending.clear()
+        self.cache.clear()
@@ -5,7 +5,13 @@ Provides a queue that can be used between multiple processes via MongoDB
 """
 
 from datetime import datetime, timedelta
-from pymongo import MongoClient, errors
+import time
+import urllib.parse
+import uuid
+
+from pymongo import MongoClient, ASCENDING, DESCENDING, errors
+
+from scheduler import DomainScheduler
 
 
 class MongoQueue(object):
@@ -14,16 +20,18 @@ class MongoQueue(object):
     >>> url = 'http://example.webscraping.com'
     >>> q = MongoQueue(timeout=timeout)
     >>> q.clear() # ensure empty queue
-    >>> q.push(url) # add test URL
-    >>> q.peek() == q.pop() == url # pop back this URL
+    >>> q.put(url) # add test URL
+    >>> q.peek() == q.get() == url # pop back this URL
     True
     >>> q.repair() # immediate repair will do nothin
-    >>> q.pop() # another pop should be empty
+    0
+    >>> q.get_batch(10)[1] # another pop should be empty
+    []
     >>> q.peek()
     >>> import time; time.sleep(timeout) # wait for timeout
     >>> q.repair() # now repair will release URL
-    Released: test
-    >>> q.pop() == url # pop URL again
+    1
+    >>> q.get() == url # pop URL again
     True
     >>> bool(q) # queue is still active while outstanding
     True
@@ -44,28 +52,54 @@ class MongoQueue(object):
         self.client = MongoClient('localhost', 27017) if client is None else client
         self.db = self.client.queue
         self.timeout = timeout
+        self.create_indexes()
+
+    def create_indexes(self):
+        # repair() looks up expired leases, get() the highest priority
+        self.db.crawl_queue.create_index([('status', ASCENDING), ('timestamp', ASCENDING)])
+        self.db.crawl_queue.create_index([('status', ASCENDING), ('priority', DESCENDING)])
 
     def __bool__(self):
         """Returns True if there are more jobs to process."""
+        # an $in on the indexed status, $ne would scan
         record = self.db.crawl_queue.find_one(
-            {'status': {'$ne': self.COMPLETE}}
+            {'status': {'$in': [self.OUTSTANDING, self.PROCESSING]}},
+            projection={'_id': True}
         )
         return True if record else False
 
-    def put(self, url):
+    def put(self, url, priority=0):
         """Add new URL to queue if does not exist."""
         try:
-            self.db.crawl_queue.insert({'_id': url, 'status': self.OUTSTANDING})
+            self.db.crawl_queue.insert_one(
+                {'_id': url, 'status': self.OUTSTANDING, 'priority': priority})
         except errors.DuplicateKeyError as e:
             pass # this is already in the queue
 
+    def put_many(self, urls, priority=0):
+        """Add new URLs to queue with one unordered bulk insert,
+        skipping those already in the queue.
+        """
+        records = [{'_id': url, 'status': self.OUTSTANDING, 'priority': priority}
+                   for url in urls]
+        if not records:
+            return
+        try:
+            self.db.crawl_queue.insert_many(records, ordered=False)
+        except errors.BulkWriteError as e:
+            # 11000 is the duplicate key error
+            if any(error['code'] != 11000 for error in e.details['writeErrors']):
+                raise
+
     def get(self):
         """Get an outstanding URL from the queue and set its status to processing.
         If the queue is empty a KeyError exception is raised.
         """
-        record = self.db.crawl_queue.find_and_modify(
-            query={'status': self.OUTSTANDING},
-            update={'$set': {'status': self.PROCESSING, 'timestamp': datetime.now()}}
+        record = self.db.crawl_queue.find_one_and_update(
+            {'status': self.OUTSTANDING},
+            {'$set': {'status': self.PROCESSING, 'timestamp': datetime.now()},
+             '$unset': {'lease': ''}},
+            sort=[('priority', DESCENDING)]
         )
         if record:
             return record['_id']
@@ -73,25 +107,177 @@ class MongoQueue(object):
             self.repair()
             raise KeyError()
 
+    def get_batch(self, n):
+        """Claim up to n outstanding URLs, return (lease, urls).
+
+        The lease identifies the batch, see `release`. URLs claimed by
+        another worker in the meantime are left out, so fewer than n URLs
+        may be returned even if more are outstanding.
+        """
+        lease = uuid.uuid4().hex
+        ids = [record['_id'] for record in self.db.crawl_queue.find(
+            {'status': self.OUTSTANDING}, projection={'_id': True}
+        ).sort('priority', DESCENDING).limit(n)]
+        if not ids:
+            self.repair()
+            return lease, []
+        self.db.crawl_queue.update_many(
+            {'_id': {'$in': ids}, 'status': self.OUTSTANDING},
+            {'$set': {'status': self.PROCESSING, 'timestamp': datetime.now(), 'lease': lease}}
+        )
+        claimed = self.db.crawl_queue.find(
+            {'_id': {'$in': ids}, 'lease': lease}, projection={'_id': True})
+        return lease, [record['_id'] for record in claimed]
+
+    def release(self, lease):
+        """Put the unfinished URLs of a batch back to the queue."""
+        self.db.crawl_queue.update_many(
+            {'lease': lease, 'status': self.PROCESSING},
+            {'$set': {'status': self.OUTSTANDING}, '$unset': {'lease': ''}}
+        )
+
     def peek(self):
-        record = self.db.crawl_queue.find_one({'status': self.OUTSTANDING})
+        record = self.db.crawl_queue.find_one(
+            {'status': self.OUTSTANDING}, sort=[('priority', DESCENDING)])
         if record:
             return record['_id']
 
     def complete(self, url):
-        self.db.crawl_queue.update({'_id': url}, {'$set': {'status': self.COMPLETE}})
+        self.db.crawl_queue.update_one({'_id': url}, {'$set': {'status': self.COMPLETE}})
+
+    def complete_many(self, urls):
+        self.db.crawl_queue.update_many(
+            {'_id': {'$in': list(urls)}}, {'$set': {'status': self.COMPLETE}})
 
     def repair(self):
-        """Release stalled jobs."""
-        record = self.db.crawl_queue.find_and_modify(
-            query={
-                'timestamp': {'$lt': datetime.now() - timedelta(seconds=self.timeout)},
-                'status': {'$ne': self.COMPLETE}
+        """Release all stalled jobs, return their number."""
+        result = self.db.crawl_queue.update_many(
+            {
+                'status': self.PROCESSING,
+                'timestamp': {'$lt': datetime.now() - timedelta(seconds=self.timeout)}
             },
-            update={'$set': {'status': self.OUTSTANDING}}
+            {'$set': {'status': self.OUTSTANDING}, '$unset': {'lease': ''}}
         )
-        if record:
-            print('Released:', record['_id'])
+        return result.modified_count
 
     def clear(self):
         self.db.crawl_queue.drop()
+        self.create_indexes()
+
+
+class MongoFrontier(MongoQueue):
+    """
+    MongoQueue which only hands out URLs that can be fetched now
+
+    URLs are stored with their domain, `get()` asks the scheduler for a
+    ready domain in turn and claims its highest priority URL. Domains with
+    outstanding URLs are reloaded every `refresh` seconds, so that URLs
+    put by other processes are seen. Every process throttles with its own
+    scheduler, the delay applies per process.
+
+    >>> frontier = MongoFrontier(delay=60)
+    >>> frontier.clear()
+    >>> frontier.put_many(['http://a.com/1', 'http://a.com/2', 'http://b.com/1'])
+    >>> sorted([frontier.get(), frontier.get()])
+    ['http://a.com/1', 'http://b.com/1']
+    >>> frontier.get()
+    Traceback (most recent call last):
+     ...
+    KeyError
+    >>> frontier.get_batch(10)[1]
+    []
+    """
+    def __init__(self, client=None, timeout=300, delay=5, scheduler=None, refresh=10):
+        """
+        delay: interval between downloads of the same domain (seconds)
+        scheduler: scheduler.DomainScheduler used instead of one with delay
+        refresh: seconds between reloads of the domains with work
+        """
+        self.scheduler = DomainScheduler(delay) if scheduler is None else scheduler
+        self.refresh = refresh
+        self.refreshed = None
+        MongoQueue.__init__(self, client, timeout)
+
+    def create_indexes(self):
+        MongoQueue.create_indexes(self)
+        self.db.crawl_queue.create_index(
+            [('status', ASCENDING), ('domain', ASCENDING), ('priority', DESCENDING)])
+
+    def put(self, url, priority=0):
+        """Add new URL to queue if does not exist."""
+        self.put_many([url], priority)
+
+    def put_many(self, urls, priority=0):
+        """Add new URLs to queue, skipping those already in the queue."""
+        records = []
+        for url in urls:
+            domain = urllib.parse.urlparse(url).netloc
+            records.append({'_id': url, 'status': self.OUTSTANDING,
+                            'priority': priority, 'domain': domain})
+            self.scheduler.push(domain)
+        if not records:
+            return
+        try:
+            self.db.crawl_queue.insert_many(records, ordered=False)
+        except errors.BulkWriteError as e:
+            # 11000 is the duplicate key error
+            if any(error['code'] != 11000 for error in e.details['writeErrors']):
+                raise
+
+    def load_domains(self):
+        """Schedule the domains with outstanding URLs."""
+        for domain in self.db.crawl_queue.distinct('domain', {'status': self.OUTSTANDING}):
+            self.scheduler.push(domain)
+        self.refreshed = time.monotonic()
+
+    def get(self):
+        """Get an outstanding URL of a domain ready to download and set its
+        status to processing. If there is none a KeyError exception is raised.
+        """
+        url = self.claim()
+        if url is None:
+            self.repair()
+            raise KeyError()
+        return url
+
+    def get_batch(self, n):
+        """Claim up to n URLs of domains ready to download, return (lease, urls).
+
+        Every URL takes a turn of the scheduler like `get()`, so a batch
+        holds at most `burst` URLs of a domain.
+        """
+        lease = uuid.uuid4().hex
+        urls = []
+        while len(urls) < n:
+            url = self.claim(lease)
+            if url is None:
+                break
+            urls.append(url)
+        if not urls:
+            self.repair()
+        return lease, urls
+
+    def claim(self, lease=None):
+        """Set the best URL of the next ready domain to processing and
+        return it, None if no domain is ready.
+        """
+        if self.refreshed is None or time.monotonic() - self.refreshed > self.refresh:
+            self.load_domains()
+        if lease is None:
+            update = {'$set': {'status': self.PROCESSING, 'timestamp': datetime.now()},
+                      '$unset': {'lease': ''}}
+        else:
+            update = {'$set': {'status': self.PROCESSING, 'timestamp': datetime.now(),
+                               'lease': lease}}
+        while True:
+            domain = self.scheduler.pop()
+            if domain is None:
+                return None
+            record = self.db.crawl_queue.find_one_and_update(
+                {'status': self.OUTSTANDING, 'domain': domain}, update,
+                sort=[('priority', DESCENDING)]
+            )
+            if record:
+                # the domain may have more, a drained one is dropped on its next turn
+                self.scheduler.push(domain)
+                return record['_id']
@@ -5,69 +5,201 @@ Multi-process crawler
 """
 
 
+import logging
 import multiprocessing
+import os
+import queue
+import signal
 import time
-import threading
 
+from metrics import Metrics
 from mongoqueue import MongoQueue
+from seen import SeenSet
+from workerpool import WorkerPool
 
 
+class SharedQueue(object):
+    """Queue shared by the processes of one machine through multiprocessing,
+    for crawls without a database. It has the part of the MongoQueue
+    interface used by the crawler, but does not skip duplicates and does
+    not outlive the parent process. Create it before the processes start.
+    """
+    def __init__(self):
+        self.queue = multiprocessing.Queue()
+        # put but not completed yet
+        self.unfinished = multiprocessing.Value('i', 0)
+
+    def __bool__(self):
+        """Returns True if there are more jobs to process."""
+        return self.unfinished.value > 0
+
+    def put(self, url):
+        with self.unfinished.get_lock():
+            self.unfinished.value += 1
+        self.queue.put(url)
+
+    def get_batch(self, n):
+        urls = []
+        try:
+            while len(urls) < n:
+                urls.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        return None, urls
+
+    def complete(self, url):
+        with self.unfinished.get_lock():
+            self.unfinished.value -= 1
+
 
 class MultiThreadingCrawler(object):
-    def __init__(self):
-        self.queue = MongoQueue()
+    """Crawl with a pool of threads fed from a frontier shared between processes.
+
+    Args:
+        frontier: Queue shared by the processes, e.g. SharedQueue(), or
+            a callable which creates it, called once in every process as
+            database clients must not be shared across a fork, e.g.
+            MongoQueue or functools.partial(SQLiteQueue, 'queue.db')
+        metrics: metrics.Metrics, every process fills its own copy and
+            multiProcess merges them back into it
+    """
+    def __init__(self, frontier=MongoQueue, metrics=None):
+        self.frontier = frontier
+        self.metrics = Metrics() if metrics is None else metrics
+        self.queue = None
+        self.seen = None
+        # longest wait between checks of a queue outstanding elsewhere
         self.gap = 1
 
+    def open(self):
+        """Connect to the frontier in this process."""
+        self.queue = self.frontier() if callable(self.frontier) else self.frontier
+        # spares the frontier round-trips for the links this process has
+        # queued already, the frontier still skips those of other processes
+        self.seen = SeenSet()
+
+    def put(self, url):
+        """Queue url unless this process has queued it before."""
+        if self.seen.add(url):
+            self.queue.put(url)
+        else:
+            self.metrics.inc('duplicates')
+
     def producer(self):
         for i in range(100):
-            self.queue.put(i)
-
-    def consumer(self):
-        while True:
-            if not self.queue.empty():
-                item = self.queue.get()
-                print(item)
-                self.queue.task_done()
+            self.put('http://example.webscraping.com/%d' % i)
+
+    def consumer(self, item):
+        print(item)
+
+    def handle(self, item):
+        # completed even if the consumer raised, or the queue never drains
+        try:
+            self.consumer(item)
+        finally:
+            self.queue.complete(item)
+
+    def run(self, max_threads, stop=None, report_interval=None):
+        """Process the frontier until it is finished or stop is set.
+
+        Return the stats of the worker pool.
+        """
+        if self.queue is None:
+            self.open()
+        # the pool queue is bounded, feeding blocks while the workers are busy
+        pool = WorkerPool(self.handle, max_threads, maxsize=max_threads, metrics=self.metrics)
+        pool.start()
+        if report_interval:
+            pool.report(report_interval)
+            self.metrics.report(report_interval)
+
+        wait = 0.01
+        while stop is None or not stop.is_set():
+            # a batch is always fed completely, so nothing claimed is lost on stop
+            lease, items = self.queue.get_batch(max_threads)
+            for item in items:
+                pool.put(item)
+            if items:
+                wait = 0.01
+            elif self.queue:
+                # the rest is processed by other processes, which may release it
+                if stop is None:
+                    time.sleep(wait)
+                else:
+                    stop.wait(wait)
+                wait = min(wait * 2, self.gap)
             else:
                 break
-
-    def run(self, max_threads, *args, **kwargs):
-        producer = threading.Thread(target=self.producer)
-        producer.start()
-
-        # Let the producer run for a while
-        time.sleep(self.gap)
-
-        threads = []
-        while not self.queue.empty():
-            for thread in threads:
-                if not thread.is_alive():
-                    threads.remove(thread)
-            while len(threads) < max_threads and not self.queue.empty():
-                thread = threading.Thread(target=self.consumer)
-                thread.setDaemon(True)
-                thread.start()
-                threads.append(thread)
-            # all threads have been processed
-            # sleep temporarily so CPU can focus execution on other threads
-            time.sleep(self.gap)
         # Waiting for all elements to be processed
-        self.queue.join()
+        pool.join()
+        stats = pool.stats()
+        pool.close()
+        self.metrics.close()
+        return stats
 
-    def __call__(self, *args, **kwargs):
-        self.run(*args, **kwargs)
+    def __call__(self, max_threads, stop, results, report_interval=None):
+        """Entry point of a crawler process, puts its stats to results."""
+        # the parent turns SIGINT into stop, in-flight items are finished
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        # only what this process measures is sent back
+        self.metrics = Metrics(self.metrics.max_domains, self.metrics.prefix)
+        stats = {}
+        try:
+            stats = self.run(max_threads, stop, report_interval)
+        finally:
+            stats['pid'] = os.getpid()
+            stats['metrics'] = self.metrics.snapshot()
+            results.put(stats)
 
 
-def multiProcess(max_threads, **kwargs):
-    num_cpus = multiprocessing.cpu_count()
-    # pool = multiprocessing.Pool(processes=num_cpus)
-    print('Starting {} processes'.format(num_cpus))
+def multiProcess(max_threads, num_processes=None, crawler=None, report_interval=None):
+    """Seed the frontier once, then crawl it with num_processes processes
+    of max_threads threads each. SIGINT or SIGTERM stops them gracefully.
+
+    Return the stats summed over the processes.
+    """
+    num_processes = num_processes or multiprocessing.cpu_count()
+    crawler = MultiThreadingCrawler() if crawler is None else crawler
+    crawler.open()
+    crawler.producer()
+    crawler.queue = crawler.seen = None
+
+    stop = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    print('Starting {} processes'.format(num_processes))
     processes = []
-    for i in range(num_cpus):
-        p = multiprocessing.Process(target=MultiThreadingCrawler(), args=[max_threads], kwargs=kwargs)
-        # parsed = pool.apply_async(threaded_link_crawler, args, kwargs)
+    for i in range(num_processes):
+        p = multiprocessing.Process(
+            target=crawler, args=[max_threads, stop, results, report_interval])
         p.start()
         processes.append(p)
-    # wait for processes to complete
-    for p in processes:
-        p.join()
+
+    def shutdown(signum, frame):
+        logging.warning('Stopping, waiting for in-flight items')
+        stop.set()
+    handlers = [signal.signal(signal.SIGINT, shutdown), signal.signal(signal.SIGTERM, shutdown)]
+
+    try:
+        # read the results before joining, a process exits once its result is flushed
+        reports = []
+        while len(reports) < num_processes:
+            try:
+                reports.append(results.get(timeout=1))
+            except queue.Empty:
+                if not any(p.is_alive() for p in processes) and results.empty():
+                    break
+        for p in processes:
+            p.join()
+    finally:
+        signal.signal(signal.SIGINT, handlers[0])
+        signal.signal(signal.SIGTERM, handlers[1])
+
+    for report in reports:
+        crawler.metrics.merge(report.pop('metrics'))
+    total = {'processes': len(reports)}
+    for key in ('processed', 'errors', 'throughput'):
+        total[key] = sum(report.get(key, 0) for report in reports)
+    print('Processed {processed} items with {errors} errors in {processes} processes, '
+          '{throughput:.1f} items/s'.format(**total))
+    return total
@@ -5,47 +5,89 @@ Multi-threaded crawler
 """
 
 import queue
-import time
 import threading
 
+from checkpoint import Checkpoint
+from metrics import Metrics
+from seen import SeenSet
+from workerpool import WorkerPool
+
 
 class MultiThreadingCrawler(object):
-    def __init__(self):
-        self.queue = queue.Queue()
-        self.gap = 1
+    """Crawl with a pool of threads fed by an in-memory queue.
+
+    Args:
+        frontier: Object with the queue.Queue interface, e.g. frontier.Frontier
+        seen: seen.SeenSet of the URLs queued
+        metrics: metrics.Metrics of the crawl
+        checkpoint: Path of a checkpoint.Checkpoint journal, run() resumes
+            the crawl it recorded and records the new one
+    """
+    def __init__(self, frontier=None, seen=None, metrics=None, checkpoint=None):
+        # anything with the queue.Queue interface, e.g. frontier.Frontier
+        self.queue = queue.Queue() if frontier is None else frontier
+        # URLs queued so far, saved at the end of run() if it has a path
+        self.seen = SeenSet() if seen is None else seen
+        # shared with the pool, pass it to the Downloader of consumer too
+        self.metrics = Metrics() if metrics is None else metrics
+        self.checkpoint = None if checkpoint is None else Checkpoint(checkpoint, self.seen)
+
+    def put(self, url, priority=None):
+        """Queue url unless it has been queued before.
+
+        priority: passed on to a frontier.Frontier
+        """
+        if self.seen.add(url):
+            if self.checkpoint is not None:
+                self.checkpoint.put(url, priority)
+            self.enqueue(url, priority)
+        else:
+            self.metrics.inc('duplicates')
+
+    def enqueue(self, url, priority=None):
+        if priority is None:
+            self.queue.put(url)
+        else:
+            self.queue.put(url, priority)
 
     def producer(self):
         for i in range(100):
-            self.queue.put(i)
-
-    def consumer(self):
-        while True:
-            if not self.queue.empty():
-                item = self.queue.get()
-                print(item)
-                self.queue.task_done()
-            else:
-                break
-
-    def run(self, max_threads):
+            self.put('http://example.webscraping.com/%d' % i)
+
+    def consumer(self, item):
+        print(item)
+
+    def handle(self, url):
+        """Run consumer on url, recording it in the checkpoint."""
+        self.checkpoint.start(url)
+        try:
+            self.consumer(url)
+        finally:
+            self.checkpoint.done(url)
+
+    def run(self, max_threads, report_interval=None):
+        handler = self.consumer
+        if self.checkpoint is not None:
+            handler = self.handle
+            for url, priority in self.checkpoint.restore():
+                self.enqueue(url, priority)
+        pool = WorkerPool(handler, max_threads, queue=self.queue, metrics=self.metrics)
+        pool.start()
+        if report_interval:
+            pool.report(report_interval)
+            self.metrics.report(report_interval)
+
         producer = threading.Thread(target=self.producer)
         producer.start()
-
-        # Let the producer run for a while
-        time.sleep(self.gap)
-
-        threads = []
-        while not self.queue.empty():
-            for thread in threads:
-                if not thread.is_alive():
-                    threads.remove(thread)
-            while len(threads) < max_threads and not self.queue.empty():
-                thread = threading.Thread(target=self.consumer)
-                thread.setDaemon(True)
-                thread.start()
-                threads.append(thread)
-            # all threads have been processed
-            # sleep temporarily so CPU can focus execution on other threads
-            time.sleep(self.gap)
+        # the queue may run dry while the producer is still producing
+        producer.join()
         # Waiting for all elements to be processed
-        self.queue.join()
+        pool.join()
+        stats = pool.stats()
+        pool.close()
+        self.metrics.close()
+        if self.checkpoint is not None:
+            self.checkpoint.close()
+        if self.seen.path:
+            self.seen.save()
+        return stats
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+"""
+When and how long to wait before retrying a failed download
+"""
+
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import random
+import threading
+import time
+
+
+class CircuitBreaker(object):
+    """Stop sending requests to a host after repeated failures.
+
+    After `threshold` failures in a row the circuit of the host opens and
+    requests are refused at once for `cooldown` seconds. Then a single
+    trial request is let through, its success closes the circuit, its
+    failure opens it again.
+
+    >>> clock = [0]
+    >>> breaker = CircuitBreaker(threshold=2, cooldown=10, clock=lambda: clock[0])
+    >>> breaker.failure('a.com'); breaker.allow('a.com')
+    True
+    >>> breaker.failure('a.com'); breaker.allow('a.com')
+    False
+    >>> clock[0] = 10
+    >>> breaker.allow('a.com'), breaker.allow('a.com')
+    (True, False)
+    >>> breaker.success('a.com'); breaker.allow('a.com')
+    True
+    """
+    def __init__(self, threshold=5, cooldown=30, clock=time.monotonic):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        # host -> number of failures in a row, only for failing hosts
+        self.failures = {}
+        # host -> time the circuit opened or its last trial started
+        self.opened = {}
+        self.lock = threading.Lock()
+
+    def allow(self, host):
+        """Whether a request may be sent to host now."""
+        with self.lock:
+            opened = self.opened.get(host)
+            if opened is None:
+                return True
+            now = self.clock()
+            if now - opened < self.cooldown:
+                return False
+            # half open, the requests after the trial wait another cooldown
+            self.opened[host] = now
+            return True
+
+    def success(self, host):
+        with self.lock:
+            self.failures.pop(host, None)
+            self.opened.pop(host, None)
+
+    def failure(self, host):
+        with self.lock:
+            failures = self.failures.get(host, 0) + 1
+            self.failures[host] = failures
+            if failures >= self.threshold:
+                self.opened[host] = self.clock()
+
+    def is_open(self, host):
+        return host in self.opened
+
+
+class RetryPolicy(object):
+    """Which failures are retried and how long to wait before each retry.
+
+    Waits grow exponentially with full jitter, a random time up to
+    `backoff * 2 ** attempt`, so that the workers retrying a host do not
+    come back at the same time. A Retry-After header is honoured, a
+    retry is not attempted if it asks to wait longer than `max_backoff`.
+
+    >>> policy = RetryPolicy(num_retries=3, backoff=1, max_backoff=8)
+    >>> [0 <= policy.delay(attempt) <= 2 ** attempt for attempt in range(3)]
+    [True, True, True]
+    >>> policy.delay(0, '5'), policy.delay(0, '60')
+    (5.0, None)
+
+    Args:
+        num_retries: Number of retries of a failed download
+        backoff: Wait before the first retry (seconds), doubled every retry
+        max_backoff: Longest wait before a retry (seconds)
+        jitter: Whether the waits are randomized
+        statuses: HTTP status codes which are retried
+        exceptions: Exception classes which are retried, None for the
+            connection errors and timeouts of the downloader's library
+        breaker: CircuitBreaker shared by the requests, None to disable it
+    """
+    def __init__(self, num_retries=1, backoff=0.5, max_backoff=60, jitter=True,
+                 statuses=(429, 500, 502, 503, 504), exceptions=None,
+                 breaker=None):
+        self.num_retries = num_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.statuses = frozenset(statuses)
+        self.exceptions = exceptions
+        self.breaker = CircuitBreaker() if breaker is None else breaker or None
+
+    def retry_status(self, status):
+        return status in self.statuses
+
+    def delay(self, attempt, retry_after=None):
+        """Seconds to wait before retry number attempt + 1, None to give up.
+
+        retry_after: value of the Retry-After header of the failed response
+        """
+        wait = min(self.max_backoff, self.backoff * 2 ** attempt)
+        if self.jitter:
+            wait = random.uniform(0, wait)
+        if retry_after:
+            asked = parse_retry_after(retry_after)
+            if asked is not None:
+                if asked > self.max_backoff:
+                    return None
+                wait = max(wait, asked)
+        return wait
+
+    def allow(self, host):
+        return self.breaker is None or self.breaker.allow(host)
+
+    def success(self, host):
+        if self.breaker is not None:
+            self.breaker.success(host)
+
+    def failure(self, host):
+        if self.breaker is not None:
+            self.breaker.failure(host)
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header, in seconds or as a date.
+
+    >>> parse_retry_after('120'), parse_retry_after('soon')
+    (120.0, None)
+    """
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    date = parse_http_date(value)
+    if date is None:
+        return None
+    return max((date - datetime.utcnow()).total_seconds(), 0)
+
+
+def parse_http_date(value):
+    """Naive UTC datetime of an HTTP date header, None if it is invalid.
+
+    >>> parse_http_date('Thu, 01 Jan 1970 01:01:01 GMT')
+    datetime.datetime(1970, 1, 1, 1, 1, 1)
+    """
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return None
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+
+"""
+Cache of the robots.txt rules of every domain
+"""
+
+from collections import OrderedDict
+import logging
+import re
+import threading
+import time
+import urllib.parse
+
+import requests
+
+
+# characters left as they are when paths are normalized
+SAFE = "/?=&;:@$!,+*'()~"
+
+
+def normalize(path):
+    """Same percent-encoding for the rules and the paths they are applied to."""
+    if '%' in path or not path.isascii():
+        return urllib.parse.quote(urllib.parse.unquote(path), safe=SAFE)
+    return path
+
+
+class RobotRules(object):
+    """Rules of a robots.txt for one user agent.
+
+    Plain rules are kept in a trie walked once along the path, so
+    `allowed` is O(path length) whatever the number of rules. The
+    longest matching rule wins and Allow wins ties, the rare rules with
+    `*` or `$` wildcards are checked as regular expressions.
+
+    >>> rules = RobotRules.parse('''
+    ... User-agent: *
+    ... Disallow: /private
+    ... Allow: /private/public
+    ... Disallow: /*.pdf$
+    ... Crawl-delay: 2
+    ... ''', 'awsl')
+    >>> rules.allowed('/private/a'), rules.allowed('/private/public/a'), rules.allowed('/a')
+    (False, True, True)
+    >>> rules.allowed('/a.pdf'), rules.allowed('/a.pdf?x'), rules.crawl_delay
+    (False, True, 2.0)
+    """
+    def __init__(self, allow_all=True, crawl_delay=None):
+        self.allow_all = allow_all
+        self.crawl_delay = crawl_delay
+        # nested dicts of characters, the None key holds (length, allowed)
+        self.trie = {}
+        # (length, allowed, regex) of wildcard rules
+        self.patterns = []
+
+    @classmethod
+    def parse(cls, text, user_agent):
+        """Rules of the group of text matching user_agent best, or of `*`."""
+        agent = user_agent.split('/')[0].lower()
+        groups = {}
+        names, in_rules = [], False
+        for line in text.splitlines():
+            line = line.split('#', 1)[0].strip()
+            if ':' not in line:
+                continue
+            field, value = line.split(':', 1)
+            field, value = field.strip().lower(), value.strip()
+            if field == 'user-agent':
+                if in_rules:
+                    names, in_rules = [], False
+                names.append(value.lower())
+                groups.setdefault(names[-1], [])
+            elif field in ('allow', 'disallow', 'crawl-delay') and names:
+                in_rules = True
+                for name in names:
+                    groups[name].append((field, value))
+
+        # the longest agent name contained in our product token
+        matches = [name for name in groups if name != '*' and name in agent]
+        lines = groups[max(matches, key=len)] if matches else groups.get('*', [])
+        rules = cls()
+        for field, value in lines:
+            if field == 'crawl-delay':
+                try:
+                    rules.crawl_delay = float(value)
+                except ValueError:
+                    pass
+            elif value:
+                rules.add(value, field == 'allow')
+        return rules
+
+    def add(self, path, allowed):
+        path = normalize(path)
+        if '*' in path or path.endswith('$'):
+            pattern = re.escape(path.rstrip('$')).replace(r'\*', '.*')
+            if path.endswith('$'):
+                pattern += r'\Z'
+            self.patterns.append((len(path), allowed, re.compile(pattern)))
+            return
+        node = self.trie
+        for char in path:
+            node = node.setdefault(char, {})
+        # Allow wins over a Disallow of the same path
+        node[None] = (len(path), allowed or node.get(None, (0, False))[1])
+
+    def allowed(self, path):
+        """Whether path, with its query string, may be downloaded."""
+        if not self.trie and not self.patterns:
+            return self.allow_all
+        path = normalize(path or '/')
+        if path == '/robots.txt':
+            return True
+        length, allowed = 0, True
+        node = self.trie
+        for char in path:
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                length, allowed = node[None]
+        for rule_length, rule_allowed, pattern in self.patterns:
+            if rule_length > length or (rule_length == length and rule_allowed):
+                if pattern.match(path):
+                    length, allowed = rule_length, rule_allowed
+        return allowed
+
+
+class RobotsCache(object):
+    """robots.txt rules of the domains seen by a downloader.
+
+    A robots.txt is downloaded through the session and throttle of the
+    downloader the first time a domain is checked, and again once its
+    ttl passed. A missing robots.txt (4xx) allows everything and is cached
+    like a found one, a server error or failed download disallows the
+    domain until `error_ttl` passed. The Crawl-delay of a domain is set on
+    the throttle of the downloader when it has a `set_delay` method. It
+    can only lengthen the delay of the throttle, up to `max_crawl_delay`.
+
+    Args:
+        downloader: downloader.Downloader whose session and throttle are used
+        ttl: Seconds robots.txt and missing robots.txt are cached
+        error_ttl: Seconds a domain stays disallowed after a failure
+        max_domains: Number of domains kept, least recently used first evicted
+        max_crawl_delay: Longest Crawl-delay obeyed (seconds), longer ones
+            are cut to it
+    """
+    def __init__(self, downloader, ttl=24 * 3600, error_ttl=300, max_domains=10000,
+                 max_crawl_delay=60):
+        self.downloader = downloader
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.max_domains = max_domains
+        self.max_crawl_delay = max_crawl_delay
+        self.user_agent = downloader.session.headers.get('user-agent', '*')
+        # origin -> (expires, rules)
+        self.domains = OrderedDict()
+        self.lock = threading.Lock()
+        # origin -> lock held while its robots.txt is downloaded
+        self.fetching = {}
+
+    def can_fetch(self, url):
+        """Whether the robots.txt of its domain allows downloading url."""
+        parts = urllib.parse.urlsplit(url)
+        origin = '%s://%s' % (parts.scheme, parts.netloc)
+        path = parts.path + '?' + parts.query if parts.query else parts.path
+        return self.rules(origin).allowed(path)
+
+    def rules(self, origin):
+        """Return the RobotRules of origin, downloading them if needed."""
+        entry = self.lookup(origin)
+        if entry is not None:
+            return entry
+        with self.lock:
+            lock = self.fetching.setdefault(origin, threading.Lock())
+        with lock:
+            # another thread may have downloaded it meanwhile
+            entry = self.lookup(origin)
+            if entry is None:
+                rules, ttl = self.download(origin)
+                self.store(origin, rules, ttl)
+                entry = rules
+        with self.lock:
+            self.fetching.pop(origin, None)
+        return entry
+
+    def lookup(self, origin):
+        with self.lock:
+            entry = self.domains.get(origin)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self.domains[origin]
+                return None
+            self.domains.move_to_end(origin)
+            return entry[1]
+
+    def store(self, origin, rules, ttl):
+        with self.lock:
+            self.domains[origin] = (time.monotonic() + ttl, rules)
+            self.domains.move_to_end(origin)
+            while len(self.domains) > self.max_domains:
+                self.domains.popitem(last=False)
+        throttle = self.downloader.throttle
+        if rules.crawl_delay is not None and hasattr(throttle, 'set_delay'):
+            delay = max(getattr(throttle, 'delay', 0),
+                        min(rules.crawl_delay, self.max_crawl_delay))
+            throttle.set_delay(urllib.parse.urlsplit(origin).netloc, delay)
+
+    def download(self, origin):
+        """Download and parse the robots.txt of origin, return (rules, ttl)."""
+        url = origin + '/robots.txt'
+        self.downloader.throttle.wait(url)
+        try:
+            logging.info('Downloading: %s' % url)
+            response = self.downloader.session.get(url, timeout=self.downloader.timeout)
+        except requests.exceptions.RequestException as e:
+            logging.warning('robots.txt download failed: %s' % e)
+            return RobotRules(allow_all=False), self.error_ttl
+        if response.status_code >= 500:
+            logging.warning('robots.txt download failed: %s %d' % (url, response.status_code))
+            return RobotRules(allow_all=False), self.error_ttl
+        if response.status_code >= 400:
+            return RobotRules(allow_all=True), self.ttl
+        return RobotRules.parse(response.text, self.user_agent), self.ttl
+
+    def clear(self):
+        with self.lock:
+            self.domains.clear()
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+
+"""
+Per-domain download scheduling with token buckets
+"""
+
+from collections import OrderedDict
+import heapq
+import threading
+import time
+import urllib.parse
+
+
+class TokenBucket(object):
+    """Allow `rate` downloads per second with bursts of up to `burst`.
+
+    Tokens may go negative, which means that downloads have been booked
+    ahead of time and the next one has to wait for the debt to refill.
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        if self.rate == float('inf'):
+            self.tokens = self.burst
+        else:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Seconds until a token is available."""
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        """Book a token and return the seconds to wait before using it."""
+        delay = self.delay(now)
+        self.tokens -= 1
+        return delay
+
+
+class DomainScheduler(object):
+    """Throttle downloads per domain without sleeping in the scheduler.
+
+    Every domain gets a token bucket refilled from a monotonic clock, so
+    fractional delays are honoured. Domains with pending work are kept in
+    a heap by the time they become ready, a worker pool can `pop()` a
+    ready domain in O(log n) instead of sleeping on a slow one.
+
+    >>> scheduler = DomainScheduler(delay=0.5)
+    >>> scheduler.push('a.com'); scheduler.push('b.com')
+    >>> sorted([scheduler.pop(), scheduler.pop()])
+    ['a.com', 'b.com']
+    >>> scheduler.push('a.com')
+    >>> scheduler.pop() is None
+    True
+    >>> 0 < scheduler.next_ready()[1] <= 0.5
+    True
+
+    It can also replace Throttle, `wait(url)` sleeps until the domain is ready.
+
+    Args:
+        delay: Interval between downloads of the same domain (seconds)
+        burst: Number of downloads allowed at once after a domain idled
+        max_domains: Number of domain buckets kept, least recently used
+            idle domains are evicted beyond it, with their own delay
+    """
+    def __init__(self, delay=5, burst=1, max_domains=10000, clock=time.monotonic):
+        self.delay = delay
+        self.burst = burst
+        self.max_domains = max_domains
+        self.clock = clock
+        # the rate of a bucket holds the delay of its domain, which may be
+        # its own, e.g. set by Crawl-delay
+        self.buckets = OrderedDict()
+        # (ready time, domain) of domains with pending work, entries whose
+        # time differs from `pending` are stale and skipped
+        self.heap = []
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, domain, now):
+        bucket = self.buckets.get(domain)
+        if bucket is None:
+            delay = self.delay
+            rate = 1.0 / delay if delay > 0 else float('inf')
+            bucket = self.buckets[domain] = TokenBucket(rate, self.burst, now)
+            self.evict()
+        else:
+            self.buckets.move_to_end(domain)
+        return bucket
+
+    def set_delay(self, domain, delay):
+        """Use delay between downloads from domain instead of the default,
+        until its bucket is evicted.
+        """
+        with self.lock:
+            now = self.clock()
+            bucket = self.bucket(domain, now)
+            bucket.refill(now)
+            bucket.rate = 1.0 / delay if delay > 0 else float('inf')
+
+    def evict(self):
+        """Drop least recently used buckets of domains without pending work."""
+        while len(self.buckets) > self.max_domains:
+            # from the least recently used end, without copying the keys
+            for domain in self.buckets:
+                if domain not in self.pending:
+                    break
+            else:
+                return
+            del self.buckets[domain]
+
+    def ready_in(self, domain):
+        """Seconds until a download from domain is allowed."""
+        with self.lock:
+            now = self.clock()
+            return self.bucket(domain, now).delay(now)
+
+    def reserve(self, url):
+        """Book a download of url and return the seconds to wait before it."""
+        domain = urllib.parse.urlparse(url).netloc
+        with self.lock:
+            now = self.clock()
+            return self.bucket(domain, now).take(now)
+
+    def wait(self, url):
+        sleep_secs = self.reserve(url)
+        if sleep_secs > 0:
+            time.sleep(sleep_secs)
+
+    def push(self, domain):
+        """Mark domain as having work to download."""
+        with self.lock:
+            if domain in self.pending:
+                return
+            now = self.clock()
+            ready = now + self.bucket(domain, now).delay(now)
+            self.pending[domain] = ready
+            heapq.heappush(self.heap, (ready, domain))
+
+    def pop(self):
+        """Return a domain ready to download now and book its token.
+
+        The domain is no longer pending, push it again if it has more work.
+        Return None if no domain is ready.
+        """
+        with self.lock:
+            while self.heap:
+                ready, domain = self.heap[0]
+                if self.pending.get(domain) != ready:
+                    heapq.heappop(self.heap)
+                    continue
+                now = self.clock()
+                if ready > now:
+                    return None
+                bucket = self.bucket(domain, now)
+                delay = bucket.delay(now)
+                if delay > 0:
+                    # tokens were booked by reserve() since it was pushed
+                    self.pending[domain] = now + delay
+                    heapq.heapreplace(self.heap, (now + delay, domain))
+                    continue
+                heapq.heappop(self.heap)
+                del self.pending[domain]
+                bucket.take(now)
+                return domain
+            return None
+
+    def next_ready(self):
+        """Return (domain, seconds until ready) of the next pending domain,
+        or None if no domain is pending.
+        """
+        with self.lock:
+            while self.heap:
+                ready, domain = self.heap[0]
+                if self.pending.get(domain) == ready:
+                    return domain, max(ready - self.clock(), 0)
+                heapq.heappop(self.heap)
+            return None
+
+    def __len__(self):
+        """Number of domains with pending work."""
+        return len(self.pending)
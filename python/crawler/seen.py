@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+"""
+Remember the URLs already queued with canonical URLs and Bloom filters
+"""
+
+import hashlib
+import math
+import os
+import pickle
+import re
+import tempfile
+import threading
+import urllib.parse
+
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+# most links are already canonical, they skip the parsing
+CANONICAL = re.compile(r'https?://[a-z0-9.-]*[a-z0-9]/[^?#\s]*\Z')
+
+
+def canonicalize_url(url):
+    """Return the form of url used to detect duplicates.
+
+    >>> canonicalize_url('HTTP://Example.COM:80/a?b=2&a=1#top')
+    'http://example.com/a?a=1&b=2'
+    >>> canonicalize_url('https://example.com:8443')
+    'https://example.com:8443/'
+    """
+    if CANONICAL.match(url):
+        return url
+    parts = urllib.parse.urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or '').rstrip('.')
+    if ':' in netloc:
+        netloc = '[%s]' % netloc
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        netloc += ':%d' % parts.port
+    if parts.username:
+        userinfo = parts.username
+        if parts.password:
+            userinfo += ':' + parts.password
+        netloc = userinfo + '@' + netloc
+    query = urllib.parse.urlencode(
+        sorted(urllib.parse.parse_qsl(parts.query, keep_blank_values=True)))
+    return urllib.parse.urlunsplit((scheme, netloc, parts.path or '/', query, ''))
+
+
+def hashes(key):
+    """Two 64 bit hashes of key, all bit positions are derived from them."""
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+    return int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+
+
+class BloomFilter(object):
+    """Set membership in about 1.2 bytes per item for a 1% false positive rate.
+
+    >>> bloom = BloomFilter(1000, 0.01)
+    >>> bloom.add('a'), bloom.add('a'), 'a' in bloom, 'b' in bloom
+    (True, False, True, False)
+    """
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def __contains__(self, key):
+        return self.contains(*hashes(key))
+
+    def add(self, key):
+        """Add key, return False if it was (probably) already there."""
+        return self.insert(*hashes(key))
+
+    def contains(self, h1, h2):
+        bits, num_bits = self.bits, self.num_bits
+        for i in range(self.num_hashes):
+            # double hashing
+            p = (h1 + i * h2) % num_bits
+            if not bits[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+    def insert(self, h1, h2):
+        new = False
+        bits, num_bits = self.bits, self.num_bits
+        for i in range(self.num_hashes):
+            p = (h1 + i * h2) % num_bits
+            mask = 1 << (p & 7)
+            if not bits[p >> 3] & mask:
+                bits[p >> 3] |= mask
+                new = True
+        if new:
+            self.count += 1
+        return new
+
+    def __len__(self):
+        return self.count
+
+
+class ScalableBloomFilter(object):
+    """Bloom filter which grows with the number of items.
+
+    A new filter, `growth` times larger with a `ratio` times lower error
+    rate, is added when the last one is full, so the overall false
+    positive rate stays below error_rate.
+
+    >>> bloom = ScalableBloomFilter(100, 0.01)
+    >>> sum(bloom.add(str(i)) for i in range(1000)) > 980
+    True
+    >>> len(bloom.filters) > 1
+    True
+    """
+    def __init__(self, initial_capacity=100000, error_rate=0.001, growth=2, ratio=0.5):
+        self.initial_capacity = initial_capacity
+        self.error_rate = error_rate
+        self.growth = growth
+        self.ratio = ratio
+        self.filters = []
+
+    def __contains__(self, key):
+        h1, h2 = hashes(key)
+        return any(bloom.contains(h1, h2) for bloom in reversed(self.filters))
+
+    def add(self, key):
+        """Add key, return False if it was (probably) already there."""
+        h1, h2 = hashes(key)
+        if any(bloom.contains(h1, h2) for bloom in self.filters[:-1]):
+            return False
+        if self.filters and len(self.filters[-1]) >= self.filters[-1].capacity:
+            if self.filters[-1].contains(h1, h2):
+                return False
+            self.grow()
+        elif not self.filters:
+            self.grow()
+        return self.filters[-1].insert(h1, h2)
+
+    def grow(self):
+        n = len(self.filters)
+        self.filters.append(BloomFilter(
+            self.initial_capacity * self.growth ** n,
+            self.error_rate * (1 - self.ratio) * self.ratio ** n))
+
+    def __len__(self):
+        return sum(len(bloom) for bloom in self.filters)
+
+
+class SeenSet(object):
+    """URLs already queued, compared in canonical form.
+
+    >>> seen = SeenSet()
+    >>> seen.add('http://example.com/a#top'), seen.add('HTTP://EXAMPLE.COM/a')
+    (True, False)
+    >>> 'http://example.com:80/a' in seen
+    True
+
+    Args:
+        path: File the set is loaded from if it exists and saved to
+        capacity: Expected number of URLs, the filter grows beyond it
+        error_rate: Rate of new URLs wrongly reported as seen
+    """
+    def __init__(self, path=None, capacity=100000, error_rate=0.001):
+        self.path = path
+        self.lock = threading.Lock()
+        self.bloom = ScalableBloomFilter(capacity, error_rate)
+        if path and os.path.exists(path):
+            self.load(path)
+
+    def __contains__(self, url):
+        key = canonicalize_url(url)
+        with self.lock:
+            return key in self.bloom
+
+    def add(self, url):
+        """Remember url, return True if it had not been seen before."""
+        key = canonicalize_url(url)
+        with self.lock:
+            return self.bloom.add(key)
+
+    def __len__(self):
+        return len(self.bloom)
+
+    def load(self, path):
+        """Replace the set by the one saved at path."""
+        with open(path, 'rb') as fp:
+            bloom = pickle.load(fp)
+        with self.lock:
+            self.bloom = bloom
+
+    def save(self, path=None):
+        """Write the set to path atomically."""
+        path = path or self.path
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+        with os.fdopen(fd, 'wb') as fp, self.lock:
+            pickle.dump(self.bloom, fp, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+"""
+Cache support via SQLite database
+"""
+
+from datetime import timedelta
+import os
+import sqlite3
+import threading
+import time
+
+from codec import Codec
+
+
+def connect(path):
+    """Open path in WAL mode, which lets readers run next to a writer."""
+    conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+class Connections(threading.local):
+    """One connection per thread and per process, connections are not
+    shareable between threads and must not survive a fork.
+    """
+    def __init__(self, path, setup):
+        self.path = path
+        self.setup = setup
+        self.pid = None
+        self.conn = None
+
+    def get(self):
+        if self.pid != os.getpid():
+            self.conn = connect(self.path)
+            self.setup(self.conn)
+            self.pid = os.getpid()
+        return self.conn
+
+
+class SQLiteCache(object):
+    """
+    Wrapper around SQLite to cache downloads on a single node
+
+    >>> import tempfile
+    >>> cache = SQLiteCache(tempfile.mktemp())
+    >>> url = 'http://example.webscraping.com'
+    >>> result = {'html': '...'}
+    >>> cache[url] = result
+    >>> cache[url]['html'] == result['html']
+    True
+    >>> cache.get_many([url, 'http://example.com']) == {url: result}
+    True
+    """
+    def __init__(self, path='cache.db', expires=timedelta(days=30), codec=None):
+        """
+        path: file of the database, shared by the crawler processes
+        expires: timedelta of amount of time before a cache entry is considered expired
+        codec: codec.Codec used to store values
+        """
+        self.path = path
+        self.expires = expires
+        self.codec = Codec() if codec is None else codec
+        self.connections = Connections(path, self.setup)
+
+    def setup(self, conn):
+        conn.execute('CREATE TABLE IF NOT EXISTS webpage ('
+                     'url TEXT PRIMARY KEY, result BLOB, codec TEXT, expires REAL)')
+
+    @property
+    def conn(self):
+        return self.connections.get()
+
+    def __contains__(self, url):
+        row = self.conn.execute(
+            'SELECT 1 FROM webpage WHERE url = ? AND expires > ?',
+            (url, time.time())).fetchone()
+        return row is not None
+
+    def __getitem__(self, url):
+        """Load value at this URL."""
+        return self.fetch(url)[0]
+
+    def fetch(self, url):
+        """Load value at this URL and the time.time() it expires at."""
+        row = self.conn.execute(
+            'SELECT codec, result, expires FROM webpage WHERE url = ? AND expires > ?',
+            (url, time.time())).fetchone()
+        if row:
+            return self.codec.decode(row[0], row[1]), row[2]
+        else:
+            raise KeyError(url + ' does not exist')
+
+    def __setitem__(self, url, result):
+        """Save value for this URL."""
+        self.conn.execute(
+            'INSERT OR REPLACE INTO webpage VALUES (?, ?, ?, ?)', self.record(url, result))
+
+    def record(self, url, result):
+        codec_id, data = self.codec.encode(result)
+        return url, data, codec_id, time.time() + self.expires.total_seconds()
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def get_many(self, urls, chunk_size=500):
+        """Load the values of urls, return a dict of the urls which exist."""
+        urls = list(urls)
+        found = {}
+        now = time.time()
+        for i in range(0, len(urls), chunk_size):
+            chunk = urls[i:i + chunk_size]
+            rows = self.conn.execute(
+                'SELECT url, codec, result FROM webpage WHERE expires > ? AND url IN (%s)'
+                % ', '.join('?' * len(chunk)), [now] + chunk)
+            for url, codec_id, data in rows:
+                found[url] = self.codec.decode(codec_id, data)
+        return found
+
+    def set_many(self, mapping):
+        """Save a dict of url -> value in one transaction."""
+        records = [self.record(url, result) for url, result in mapping.items()]
+        conn = self.conn
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany('INSERT OR REPLACE INTO webpage VALUES (?, ?, ?, ?)', records)
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def purge(self):
+        """Remove expired entries, return their number."""
+        return self.conn.execute('DELETE FROM webpage WHERE expires <= ?', (time.time(),)).rowcount
+
+    def clear(self):
+        self.conn.execute('DELETE FROM webpage')
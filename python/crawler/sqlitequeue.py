@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+"""
+Provides a queue that can be used between multiple processes via SQLite
+"""
+
+import sqlite3
+import time
+import uuid
+
+from sqlitecache import Connections
+
+
+class SQLiteQueue(object):
+    """
+    >>> import tempfile
+    >>> timeout = 1
+    >>> url = 'http://example.webscraping.com'
+    >>> q = SQLiteQueue(tempfile.mktemp(), timeout=timeout)
+    >>> q.put(url) # add test URL
+    >>> q.peek() == q.get() == url # pop back this URL
+    True
+    >>> q.repair() # immediate repair will do nothin
+    0
+    >>> q.get() # another pop should be empty
+    Traceback (most recent call last):
+     ...
+    KeyError
+    >>> import time; time.sleep(timeout) # wait for timeout
+    >>> q.repair() # now repair will release URL
+    1
+    >>> q.get() == url # pop URL again
+    True
+    >>> bool(q) # queue is still active while outstanding
+    True
+    >>> q.complete(url) # complete this URL
+    >>> bool(q) # queue is not complete
+    False
+    """
+
+    # possible states of a download, the same as MongoQueue
+    OUTSTANDING, PROCESSING, COMPLETE = range(3)
+
+    def __init__(self, path='queue.db', timeout=300):
+        """
+        path: file of the database, shared by the crawler processes
+        timeout: the number of seconds to allow for a timeout
+        """
+        self.path = path
+        self.timeout = timeout
+        self.connections = Connections(path, self.setup)
+
+    def setup(self, conn):
+        conn.execute('CREATE TABLE IF NOT EXISTS crawl_queue ('
+                     'url TEXT PRIMARY KEY, status INTEGER, timestamp REAL, lease TEXT)')
+        conn.execute('CREATE INDEX IF NOT EXISTS crawl_queue_status '
+                     'ON crawl_queue (status, timestamp)')
+        # queues created before the batches have no lease column
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(crawl_queue)')]
+        if 'lease' not in columns:
+            try:
+                conn.execute('ALTER TABLE crawl_queue ADD COLUMN lease TEXT')
+            except sqlite3.OperationalError:
+                # added by another process meanwhile
+                columns = [row[1] for row in conn.execute('PRAGMA table_info(crawl_queue)')]
+                if 'lease' not in columns:
+                    raise
+
+    @property
+    def conn(self):
+        return self.connections.get()
+
+    def __bool__(self):
+        """Returns True if there are more jobs to process."""
+        row = self.conn.execute(
+            'SELECT 1 FROM crawl_queue WHERE status != ? LIMIT 1', (self.COMPLETE,)).fetchone()
+        return row is not None
+
+    def put(self, url):
+        """Add new URL to queue if does not exist."""
+        self.conn.execute('INSERT OR IGNORE INTO crawl_queue (url, status) VALUES (?, ?)',
+                          (url, self.OUTSTANDING))
+
+    def put_many(self, urls):
+        """Add new URLs to queue in one transaction, skipping existing ones."""
+        conn = self.conn
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany('INSERT OR IGNORE INTO crawl_queue (url, status) VALUES (?, ?)',
+                             ((url, self.OUTSTANDING) for url in urls))
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def get(self):
+        """Get an outstanding URL from the queue and set its status to processing.
+        If the queue is empty a KeyError exception is raised.
+        """
+        # claiming in one statement is atomic between processes
+        row = self.conn.execute(
+            'UPDATE crawl_queue SET status = ?, timestamp = ?, lease = NULL WHERE url = '
+            '(SELECT url FROM crawl_queue WHERE status = ? LIMIT 1) RETURNING url',
+            (self.PROCESSING, time.time(), self.OUTSTANDING)).fetchone()
+        if row:
+            return row[0]
+        else:
+            self.repair()
+            raise KeyError()
+
+    def get_batch(self, n):
+        """Claim up to n outstanding URLs in one statement, return (lease, urls).
+        The lease identifies the batch, see `release`.
+        """
+        lease = uuid.uuid4().hex
+        rows = self.conn.execute(
+            'UPDATE crawl_queue SET status = ?, timestamp = ?, lease = ? WHERE url IN '
+            '(SELECT url FROM crawl_queue WHERE status = ? LIMIT ?) RETURNING url',
+            (self.PROCESSING, time.time(), lease, self.OUTSTANDING, n)).fetchall()
+        if not rows:
+            self.repair()
+        return lease, [row[0] for row in rows]
+
+    def release(self, lease):
+        """Put the unfinished URLs of a batch back to the queue."""
+        self.conn.execute(
+            'UPDATE crawl_queue SET status = ?, lease = NULL WHERE lease = ? AND status = ?',
+            (self.OUTSTANDING, lease, self.PROCESSING))
+
+    def peek(self):
+        row = self.conn.execute(
+            'SELECT url FROM crawl_queue WHERE status = ? LIMIT 1', (self.OUTSTANDING,)).fetchone()
+        if row:
+            return row[0]
+
+    def complete(self, url):
+        self.conn.execute('UPDATE crawl_queue SET status = ? WHERE url = ?', (self.COMPLETE, url))
+
+    def repair(self):
+        """Release stalled jobs, return their number."""
+        return self.conn.execute(
+            'UPDATE crawl_queue SET status = ?, lease = NULL WHERE status = ? AND timestamp < ?',
+            (self.OUTSTANDING, self.PROCESSING, time.time() - self.timeout)).rowcount
+
+    def clear(self):
+        self.conn.execute('DELETE FROM crawl_queue')
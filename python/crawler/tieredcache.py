@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+"""
+In-process LRU cache in front of a slower cache such as MongoCache
+"""
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from collections import OrderedDict
+import threading
+import time
+
+
+class TieredCache(object):
+    """
+    Read-through and write-through LRU layer bounded by bytes
+
+    >>> backend = {}
+    >>> cache = TieredCache(backend, max_bytes=1024)
+    >>> cache['a'] = {'html': '...'}
+    >>> backend['a'] == cache['a']
+    True
+    >>> cache.stats()['hits']
+    1
+    >>> 'b' in cache
+    False
+
+    Entries loaded from a backend with a `fetch(url)` method, returning
+    the value and the time.time() it expires at, leave memory when they
+    expire in the backend.
+    """
+    def __init__(self, backend, max_bytes=64 * 1024 * 1024, ttl=None):
+        """
+        backend: cache with the MongoCache interface
+        max_bytes: size of the pickled values kept in memory
+        ttl: seconds an entry is served from memory, defaults to the
+             `expires` of the backend so both layers age alike
+        """
+        self.backend = backend
+        self.max_bytes = max_bytes
+        if ttl is None and getattr(backend, 'expires', None) is not None:
+            ttl = backend.expires.total_seconds()
+        self.ttl = ttl
+        # url -> (value, size, monotonic expiry time or None)
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+        self.lock = threading.Lock()
+
+    def lookup(self, url):
+        """Return the entry of url held in memory or None."""
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is None:
+                return None
+            if entry[2] is not None and entry[2] < time.monotonic():
+                self.discard(url)
+                return None
+            self.entries.move_to_end(url)
+            return entry
+
+    def store(self, url, result, expires=None):
+        """Keep result in memory, evicting least recently used entries.
+
+        expires: time.time() the value expires at in the backend, it is
+            dropped from memory then at the latest
+        """
+        ttl = self.ttl
+        if expires is not None:
+            left = expires - time.time()
+            if left <= 0:
+                return
+            ttl = left if ttl is None else min(ttl, left)
+        size = len(pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+        if size > self.max_bytes:
+            return
+        expires = None if ttl is None else time.monotonic() + ttl
+        with self.lock:
+            self.discard(url)
+            self.entries[url] = (result, size, expires)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted, _) = self.entries.popitem(last=False)
+                self.size -= evicted
+                self.evictions += 1
+
+    def discard(self, url):
+        entry = self.entries.pop(url, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def __contains__(self, url):
+        return self.lookup(url) is not None or url in self.backend
+
+    def __getitem__(self, url):
+        """Load value at this URL from memory, then from the backend."""
+        entry = self.lookup(url)
+        with self.lock:
+            if entry is not None:
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        fetch = getattr(self.backend, 'fetch', None)
+        if fetch is None:
+            result, expires = self.backend[url], None
+        else:
+            result, expires = fetch(url)
+        self.store(url, result, expires)
+        return result
+
+    def __setitem__(self, url, result):
+        """Save value for this URL in the backend and in memory."""
+        self.backend[url] = result
+        self.store(url, result)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def stats(self):
+        """Counters to size the memory layer."""
+        with self.lock:
+            return {
+                'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self.entries), 'bytes': self.size,
+            }
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+        self.backend.clear()
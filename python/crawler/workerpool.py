@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+"""
+Pool of persistent worker threads consuming a queue
+"""
+
+import logging
+from queue import Queue, Empty
+import threading
+import time
+
+
+class WorkerPool(object):
+    """Run handler on every item put to the queue with a fixed set of threads.
+
+    Workers block on the queue instead of polling it, `join()` returns once
+    every item put has been handled and `close()` stops the workers.
+
+    >>> results = []
+    >>> pool = WorkerPool(results.append, num_workers=4)
+    >>> for i in range(100):
+    ...     pool.put(i)
+    >>> pool.join()
+    >>> pool.close()
+    >>> sorted(results) == list(range(100))
+    True
+
+    Args:
+        handler: Function called with every item
+        num_workers: Number of worker threads
+        queue: Object with the queue.Queue interface to consume, e.g.
+            frontier.Frontier, a new queue.Queue(maxsize) by default
+        maxsize: Bound of the default queue, `put` blocks when it is full
+        timeout: Seconds a worker waits for an item before checking
+            whether the pool is closed, only used with a given queue
+        metrics: metrics.Metrics recording the time spent on every item
+            as `item_seconds` and the failures as `item_errors`
+    """
+    # put once per worker to the default queue by close()
+    sentinel = object()
+
+    def __init__(self, handler, num_workers=8, queue=None, maxsize=0, timeout=1.0,
+                 metrics=None):
+        self.handler = handler
+        self.num_workers = num_workers
+        self.own_queue = queue is None
+        self.queue = Queue(maxsize) if queue is None else queue
+        self.timeout = timeout
+        self.metrics = metrics
+        self.closed = threading.Event()
+        self.threads = []
+        self.lock = threading.Lock()
+        self.processed = self.errors = self.busy = 0
+        self.started = None
+        self.reporter = None
+
+    def start(self):
+        """Start the workers, done by `put` if needed."""
+        with self.lock:
+            if self.started is not None:
+                return
+            self.started = time.monotonic()
+            for i in range(self.num_workers):
+                thread = threading.Thread(target=self.worker, name='worker-%d' % i, daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def put(self, item, *args, **kwargs):
+        if self.started is None:
+            self.start()
+        self.queue.put(item, *args, **kwargs)
+
+    def worker(self):
+        # only own queues get sentinels, others are left by timeout
+        timeout = None if self.own_queue else self.timeout
+        while not self.closed.is_set() or self.own_queue:
+            try:
+                item = self.queue.get(timeout=timeout)
+            except Empty:
+                continue
+            if item is self.sentinel:
+                self.queue.task_done()
+                break
+            with self.lock:
+                self.busy += 1
+            start = time.monotonic()
+            try:
+                self.handler(item)
+            except Exception:
+                logging.exception('Worker failed on %r' % (item,))
+                with self.lock:
+                    self.errors += 1
+                if self.metrics is not None:
+                    self.metrics.inc('item_errors')
+            finally:
+                if self.metrics is not None:
+                    self.metrics.observe('item_seconds', time.monotonic() - start)
+                with self.lock:
+                    self.busy -= 1
+                    self.processed += 1
+                self.queue.task_done()
+
+    def join(self):
+        """Wait until every item put has been handled."""
+        self.queue.join()
+
+    def close(self):
+        """Stop the workers once they finish their current item."""
+        self.closed.set()
+        if self.own_queue:
+            for _ in self.threads:
+                self.queue.put(self.sentinel)
+        for thread in self.threads:
+            thread.join()
+        if self.reporter is not None:
+            self.reporter.join()
+
+    def stats(self):
+        """Live counters of the pool."""
+        with self.lock:
+            elapsed = time.monotonic() - self.started if self.started else 0
+            return {
+                'processed': self.processed, 'errors': self.errors,
+                'busy': self.busy, 'queued': self.queue.qsize(),
+                'workers': sum(thread.is_alive() for thread in self.threads),
+                'throughput': self.processed / elapsed if elapsed else 0.0,
+            }
+
+    def report(self, interval=10):
+        """Log throughput and queue depth every interval seconds until closed."""
+        def run():
+            last = self.stats()['processed']
+            while not self.closed.wait(interval):
+                stats = self.stats()
+                logging.info('%.1f items/s, %d queued, %d busy, %d processed, %d errors' % (
+                    (stats['processed'] - last) / interval, stats['queued'],
+                    stats['busy'], stats['processed'], stats['errors']))
+                last = stats['processed']
+        self.reporter = threading.Thread(target=run, daemon=True)
+        self.reporter.start()
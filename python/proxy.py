@@ -1,58 +1,998 @@
 #!/usr/bin/env python3
 
 """
-proxy.py - A simple tcp proxy(Python3.5+).
+proxy.py - A simple tcp proxy(Python3.8+, --splice needs Linux and Python3.10+).
 """
 
 import argparse
 import asyncio
+import bisect
+import collections
+import errno
+import hashlib
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import socket
+import time
 
+from crawler.metrics import BYTES, SECONDS, Histogram, escape
 
-async def copy_one_direction(reader, writer):
-    while True:
-        data = await reader.read(1024)
-        if not data:
-            break
-        writer.write(data)
-        await writer.drain()
-    writer.close()
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 
-def main(local_addr: str, remote_addr: str):
-    local_host, local_port = local_addr.split(':')
-    remote_host, remote_port = remote_addr.split(':')
+def parse_addr(addr: str):
+    host, port = addr.rsplit(':', 1)
+    return host, int(port)
 
-    async def handle_accept(reader, writer):
-        print('connection from', writer.get_extra_info('peername'))
 
-        remote_reader, remote_writer = await asyncio.open_connection(
-            remote_host, remote_port)
+async def open_connection(host, port):
+    """Connect a non-blocking socket to host:port."""
+    loop = asyncio.get_running_loop()
+    family, type_, proto, _, address = (await loop.getaddrinfo(
+        host, port, type=socket.SOCK_STREAM))[0]
+    sock = socket.socket(family, type_, proto)
+    sock.setblocking(False)
+    try:
+        await loop.sock_connect(sock, address)
+    except BaseException:
+        sock.close()
+        raise
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def alive(sock):
+    """Whether an idle connection has not been closed by the other end."""
+    try:
+        return sock.recv(1, socket.MSG_PEEK) != b''
+    except BlockingIOError:
+        return True
+    except OSError:
+        return False
+
+
+class Upstream:
+    """A backend, its number of connections and its pool of idle connections."""
+
+    def __init__(self, addr: str):
+        self.name = addr
+        self.host, self.port = parse_addr(addr)
+        self.active = 0
+        self.fails = 0
+        self.errors = 0
+        self.ejected_until = 0.0
+        self.idle = collections.deque()
+        self.filling = False
+
+    def healthy(self, now):
+        return now >= self.ejected_until
+
+
+class Balancer:
+    """Spread the connections over the upstreams.
+
+    Strategies:
+        round-robin: each upstream in turn
+        least-conn: the upstream with the fewest active connections
+        hash: always the same upstream for a client ip, consistent hashing
+            moves few clients when an upstream is ejected
+
+    An upstream is ejected for fail_timeout seconds after max_fails failed
+    connects in a row, by clients or by the health checks. The others are
+    tried in order when a connect fails or times out.
+
+    Args:
+        remotes: host:port of the upstreams
+        pool_size: Number of idle connections kept open to every upstream,
+            taken by new clients instead of connecting
+    """
+
+    STRATEGIES = ('round-robin', 'least-conn', 'hash')
+    # points per upstream on the hash ring
+    REPLICAS = 160
+
+    def __init__(self, remotes, strategy='round-robin', connect_timeout=5.0,
+                 max_fails=3, fail_timeout=10.0, pool_size=0):
+        if strategy not in self.STRATEGIES:
+            raise ValueError('unknown strategy: {}'.format(strategy))
+        self.upstreams = [Upstream(addr) for addr in remotes]
+        self.strategy = strategy
+        self.connect_timeout = connect_timeout
+        self.max_fails = max_fails
+        self.fail_timeout = fail_timeout
+        self.pool_size = pool_size
+        self.turn = 0
+        self.ring = sorted((self.hash('{}#{}'.format(upstream.name, i)), n)
+                           for n, upstream in enumerate(self.upstreams)
+                           for i in range(self.REPLICAS))
+        self.ring_keys = [key for key, _ in self.ring]
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+    def candidates(self, client_host):
+        """Upstreams to try for a client, best first, healthy ones only
+        unless every upstream is ejected.
+        """
+        if self.strategy == 'hash':
+            start = bisect.bisect(self.ring_keys, self.hash(client_host))
+            order = []
+            for i in range(start, start + len(self.ring)):
+                n = self.ring[i % len(self.ring)][1]
+                if self.upstreams[n] not in order:
+                    order.append(self.upstreams[n])
+                    if len(order) == len(self.upstreams):
+                        break
+        else:
+            self.turn = (self.turn + 1) % len(self.upstreams)
+            order = self.upstreams[self.turn:] + self.upstreams[:self.turn]
+            if self.strategy == 'least-conn':
+                order.sort(key=lambda upstream: upstream.active)
+        now = time.monotonic()
+        return [upstream for upstream in order if upstream.healthy(now)] or order
+
+    async def connect(self, client_host):
+        """Return an upstream and a socket connected to it."""
+        error = None
+        for upstream in self.candidates(client_host):
+            sock = self.take_idle(upstream)
+            if sock is None:
+                try:
+                    sock = await asyncio.wait_for(
+                        open_connection(upstream.host, upstream.port), self.connect_timeout)
+                except (OSError, asyncio.TimeoutError) as e:
+                    error = e
+                    self.failed(upstream, e)
+                    continue
+            upstream.fails = 0
+            upstream.active += 1
+            return upstream, sock
+        raise OSError('no upstream available: {}'.format(error))
+
+    def release(self, upstream):
+        upstream.active -= 1
+
+    def failed(self, upstream, error):
+        upstream.fails += 1
+        upstream.errors += 1
+        if upstream.fails >= self.max_fails and upstream.healthy(time.monotonic()):
+            print('ejecting {} for {}s: {}'.format(upstream.name, self.fail_timeout, error))
+            upstream.ejected_until = time.monotonic() + self.fail_timeout
+
+    def take_idle(self, upstream):
+        sock = None
+        while upstream.idle:
+            candidate = upstream.idle.popleft()
+            if alive(candidate):
+                sock = candidate
+                break
+            candidate.close()
+        if self.pool_size and not upstream.filling:
+            asyncio.get_running_loop().create_task(self.fill(upstream))
+        return sock
+
+    async def fill(self, upstream):
+        """Open idle connections to upstream up to the pool size."""
+        upstream.filling = True
+        try:
+            while len(upstream.idle) < self.pool_size and upstream.healthy(time.monotonic()):
+                try:
+                    sock = await asyncio.wait_for(
+                        open_connection(upstream.host, upstream.port), self.connect_timeout)
+                except (OSError, asyncio.TimeoutError) as e:
+                    self.failed(upstream, e)
+                    break
+                upstream.idle.append(sock)
+        finally:
+            upstream.filling = False
+
+    async def check_health(self, interval):
+        """Connect to every upstream each interval seconds, to eject dead
+        ones before clients hit them and to bring back recovered ones.
+        """
+        while True:
+            for upstream in self.upstreams:
+                try:
+                    sock = await asyncio.wait_for(
+                        open_connection(upstream.host, upstream.port), self.connect_timeout)
+                except (OSError, asyncio.TimeoutError) as e:
+                    self.failed(upstream, e)
+                    continue
+                if not upstream.healthy(time.monotonic()):
+                    print('{} is back'.format(upstream.name))
+                upstream.fails = 0
+                upstream.ejected_until = 0.0
+                if self.pool_size and len(upstream.idle) < self.pool_size:
+                    upstream.idle.append(sock)
+                else:
+                    sock.close()
+            await asyncio.sleep(interval)
+
+    def close(self):
+        for upstream in self.upstreams:
+            while upstream.idle:
+                upstream.idle.popleft().close()
+
+
+class Connection:
+    """A client connection and its upstream connection, done once both
+    directions are finished, one of them failed or it is aborted.
+
+    Each side counts the bytes it reads in an int, the idle sweeps of the
+    proxy and the stats compare and sum these counters.
+    """
+
+    def __init__(self, address):
+        loop = asyncio.get_running_loop()
+        self.address = address
+        self.done = loop.create_future()
+        self.sides = []
+        self.running = 0
+        self.opened = self.idle_since = loop.time()
+        self.last_bytes = 0
+        self.reason = None
+        self.task = None
+        self.upstream = None
+
+    def traffic(self):
+        """Bytes relayed so far from the client to the upstream and back."""
+        if len(self.sides) < 2:
+            return 0, 0
+        return self.sides[0].nbytes, self.sides[1].nbytes
+
+    def add(self, side):
+        self.sides.append(side)
+        self.running += 1
+
+    def finished(self, exc=None):
+        self.running -= 1
+        if (exc is not None or not self.running) and not self.done.done():
+            self.done.set_result(exc)
+
+    def abort(self, reason=None):
+        """Close both sides at once, without waiting for the buffered data."""
+        self.reason = reason
+        for side in self.sides:
+            side.abort()
+        if not self.done.done():
+            self.done.set_result(reason)
+
+
+class Relay(asyncio.BufferedProtocol):
+    """One side of a proxied connection, what it receives is written to the
+    other side straight from a preallocated buffer.
+
+    Reading stops while the write buffer of the other side is above its
+    high water mark and resumes once it is empty. The buffer is only
+    replaced when the other side keeps part of it queued, since the
+    transport may keep a reference instead of a copy.
+
+    What arrives before the other side is connected is kept in `early`.
+    """
+
+    def __init__(self, connection, buffer_size):
+        self.connection = connection
+        self.buffer_size = buffer_size
+        self.view = memoryview(bytearray(buffer_size))
+        self.transport = None
+        self.peer = None
+        self.early = []
+        self.eof = False
+        self.lost = False
+        self.nbytes = 0
+        connection.add(self)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(high=4 * self.buffer_size, low=0)
+        peer = self.peer
+        if peer.transport is None:
+            # nowhere to write yet
+            transport.pause_reading()
+            return
+        for data in peer.early:
+            transport.write(data)
+        peer.early = []
+        if peer.lost:
+            transport.close()
+        elif peer.eof:
+            peer.forward_eof()
+        else:
+            peer.transport.resume_reading()
+
+    def get_buffer(self, sizehint):
+        return self.view
+
+    def buffer_updated(self, nbytes):
+        self.nbytes += nbytes
+        transport = self.peer.transport
+        if transport is None:
+            self.early.append(bytes(self.view[:nbytes]))
+            self.transport.pause_reading()
+            return
+        transport.write(self.view[:nbytes])
+        if transport.get_write_buffer_size():
+            self.view = memoryview(bytearray(self.buffer_size))
+
+    def pause_writing(self):
+        self.peer.transport.pause_reading()
+
+    def resume_writing(self):
+        self.peer.transport.resume_reading()
+
+    def eof_received(self):
+        self.eof = True
+        if self.peer.transport is not None:
+            self.forward_eof()
+        return True
+
+    def forward_eof(self):
+        peer = self.peer.transport
+        if self.peer.eof:
+            self.transport.close()
+            peer.close()
+        elif peer.can_write_eof():
+            # half close, the other direction goes on
+            peer.write_eof()
+        else:
+            peer.close()
+
+    def connection_lost(self, exc):
+        self.lost = True
+        peer = self.peer.transport
+        if peer is not None and not peer.is_closing():
+            peer.close()
+        self.connection.finished(exc)
+
+    def abort(self):
+        if self.transport is not None:
+            self.transport.abort()
+
+
+# move pages instead of copying them, don't block on the pipe
+SPLICE_FLAGS = getattr(os, 'SPLICE_F_MOVE', 0) | getattr(os, 'SPLICE_F_NONBLOCK', 0)
 
-        asyncio.ensure_future(copy_one_direction(reader, remote_writer))
-        asyncio.ensure_future(copy_one_direction(remote_reader, writer))
 
-    loop = asyncio.get_event_loop()
-    coro = asyncio.start_server(handle_accept, local_host, local_port, loop=loop)
-    server = loop.run_until_complete(coro)
+class Splice:
+    """One direction of a proxied connection moved in the kernel with
+    splice(2), socket -> pipe -> socket, the data never enters Python.
 
-    print('serving on {}'.format(server.sockets[0].getsockname()))
+    Reading src stops while the pipe cannot be emptied into dst.
+    """
 
+    def __init__(self, connection, src, dst, size):
+        self.connection = connection
+        self.loop = asyncio.get_running_loop()
+        self.src = src.fileno()
+        self.dst = dst
+        self.size = size
+        self.pipe_r, self.pipe_w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        try:
+            fcntl.fcntl(self.pipe_w, fcntl.F_SETPIPE_SZ, size)
+        except (AttributeError, OSError):
+            pass
+        # bytes in the pipe
+        self.pending = 0
+        self.waiting = False
+        self.closed = False
+        self.nbytes = 0
+        connection.add(self)
+
+    def start(self):
+        self.loop.add_reader(self.src, self.readable)
+
+    def readable(self):
+        try:
+            n = os.splice(self.src, self.pipe_w, self.size, flags=SPLICE_FLAGS)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self.finish(e)
+            return
+        if not n:
+            self.finish()
+            return
+        self.nbytes += n
+        self.pending += n
+        self.flush()
+
+    def flush(self):
+        while self.pending:
+            try:
+                n = os.splice(self.pipe_r, self.dst.fileno(), self.pending, flags=SPLICE_FLAGS)
+            except BlockingIOError:
+                if not self.waiting:
+                    self.waiting = True
+                    self.loop.remove_reader(self.src)
+                    self.loop.add_writer(self.dst.fileno(), self.flush)
+                return
+            except OSError as e:
+                self.finish(e)
+                return
+            self.pending -= n
+        if self.waiting:
+            self.waiting = False
+            self.loop.remove_writer(self.dst.fileno())
+            self.loop.add_reader(self.src, self.readable)
+
+    def finish(self, exc=None):
+        self.stop()
+        if exc is None:
+            try:
+                self.dst.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+        self.connection.finished(exc)
+
+    def abort(self):
+        self.stop()
+
+    def stop(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.loop.remove_reader(self.src)
+        if self.waiting:
+            self.loop.remove_writer(self.dst.fileno())
+        os.close(self.pipe_r)
+        os.close(self.pipe_w)
+
+
+# connections last longer and carry more than the requests of a crawl
+DURATION = SECONDS[:-1] + (300, 3600, float('inf'))
+TRANSFER = BYTES[:-1] + (2 ** 28, 2 ** 30, 2 ** 32, float('inf'))
+
+
+class Stats:
+    """Traffic of the proxy per client host and per upstream.
+
+    The relay only bumps the byte counters of its connection, the totals
+    here are updated once per connection when it closes. Reports add the
+    bytes of the open connections, so long transfers show up before they
+    end. More than max_clients client hosts are counted as 'other', the
+    Prometheus export only labels the top_clients busiest ones.
+    """
+
+    def __init__(self, max_clients=1000, top_clients=20):
+        self.max_clients = max_clients
+        self.top_clients = top_clients
+        # closed connections, reason -> count
+        self.closed = collections.Counter()
+        # host -> [connections, bytes up, bytes down] of the closed connections
+        self.clients = {}
+        self.upstreams = {}
+        self.duration = Histogram(DURATION)
+        self.connect = {}
+        self.bytes_up = Histogram(TRANSFER)
+        self.bytes_down = Histogram(TRANSFER)
+        self.last = None
+
+    def connected(self, connection, upstream, seconds):
+        connection.upstream = upstream.name
+        histogram = self.connect.get(upstream.name)
+        if histogram is None:
+            histogram = self.connect[upstream.name] = Histogram()
+        histogram.observe(seconds)
+
+    def finished(self, connection, reason):
+        self.closed[reason] += 1
+        up, down = connection.traffic()
+        self.duration.observe(asyncio.get_running_loop().time() - connection.opened)
+        self.bytes_up.observe(up)
+        self.bytes_down.observe(down)
+        for totals, key in ((self.clients, self.client(connection)),
+                            (self.upstreams, connection.upstream)):
+            if key is None:
+                continue
+            counts = totals.get(key)
+            if counts is None:
+                counts = totals[key] = [0, 0, 0]
+            counts[0] += 1
+            counts[1] += up
+            counts[2] += down
+
+    def client(self, connection):
+        host = connection.address[0]
+        if host in self.clients or len(self.clients) < self.max_clients:
+            return host
+        return 'other'
+
+    def collect(self, connections):
+        """Totals per client host and per upstream, the open connections
+        included: host -> [connections, bytes up, bytes down].
+        """
+        clients = {host: list(counts) for host, counts in self.clients.items()}
+        upstreams = {name: list(counts) for name, counts in self.upstreams.items()}
+        for connection in connections:
+            up, down = connection.traffic()
+            for totals, key in ((clients, self.client(connection)),
+                                (upstreams, connection.upstream)):
+                if key is None:
+                    continue
+                counts = totals.setdefault(key, [0, 0, 0])
+                counts[0] += 1
+                counts[1] += up
+                counts[2] += down
+        return clients, upstreams
+
+    def prometheus(self, connections, balancer):
+        """Dump in the Prometheus text exposition format."""
+        clients, upstreams = self.collect(connections)
+        if len(clients) > self.top_clients:
+            busiest = sorted(clients.items(), key=lambda item: -item[1][1] - item[1][2])
+            clients = dict(busiest[:self.top_clients])
+            other = clients.setdefault('other', [0, 0, 0])
+            for _, counts in busiest[self.top_clients:]:
+                for i, count in enumerate(counts):
+                    other[i] += count
+        lines = ['# TYPE proxy_connections_active gauge',
+                 'proxy_connections_active {}'.format(len(connections)),
+                 '# TYPE proxy_connections_closed_total counter']
+        for reason, count in sorted(self.closed.items()):
+            lines.append('proxy_connections_closed_total{{reason="{}"}} {}'.format(reason, count))
+        for label, totals in (('client', clients), ('upstream', upstreams)):
+            lines.append('# TYPE proxy_{}_connections_total counter'.format(label))
+            lines.extend('proxy_{}_connections_total{{{}="{}"}} {}'.format(
+                label, label, escape(key), counts[0]) for key, counts in sorted(totals.items()))
+            lines.append('# TYPE proxy_{}_bytes_total counter'.format(label))
+            for key, counts in sorted(totals.items()):
+                for direction, value in (('up', counts[1]), ('down', counts[2])):
+                    lines.append('proxy_{}_bytes_total{{{}="{}",direction="{}"}} {}'.format(
+                        label, label, escape(key), direction, value))
+        now = time.monotonic()
+        for name, kind, value in (
+                ('upstream_active', 'gauge', lambda upstream: upstream.active),
+                ('upstream_ejected', 'gauge', lambda upstream: int(not upstream.healthy(now))),
+                ('upstream_idle', 'gauge', lambda upstream: len(upstream.idle)),
+                ('upstream_connect_errors_total', 'counter', lambda upstream: upstream.errors)):
+            lines.append('# TYPE proxy_{} {}'.format(name, kind))
+            lines.extend('proxy_{}{{upstream="{}"}} {}'.format(
+                name, escape(upstream.name), value(upstream))
+                         for upstream in balancer.upstreams)
+        for name, histograms in (
+                ('connect_seconds', [('upstream="{}"'.format(escape(name)), histogram)
+                                     for name, histogram in sorted(self.connect.items())]),
+                ('connection_seconds', [('', self.duration)]),
+                ('connection_bytes', [('direction="up"', self.bytes_up),
+                                      ('direction="down"', self.bytes_down)])):
+            lines.append('# TYPE proxy_{} histogram'.format(name))
+            for label, histogram in histograms:
+                sep = ',' if label else ''
+                total = 0
+                for bound, count in zip(histogram.bounds, histogram.counts):
+                    total += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('proxy_{}_bucket{{{}{}le="{}"}} {}'.format(name, label, sep, le, total))
+                label = '{' + label + '}' if label else ''
+                lines.append('proxy_{}_sum{} {!r}'.format(name, label, histogram.sum))
+                lines.append('proxy_{}_count{} {}'.format(name, label, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self, connections, top=5):
+        """Totals, rates since the previous summary and the busiest clients
+        and upstreams, as a dict.
+        """
+        clients, upstreams = self.collect(connections)
+        now = time.monotonic()
+        up = sum(counts[1] for counts in upstreams.values())
+        down = sum(counts[2] for counts in upstreams.values())
+        summary = {'time': time.time(), 'pid': os.getpid(), 'active': len(connections),
+                   'closed': sum(self.closed.values()), 'bytes_up': up, 'bytes_down': down}
+        if self.last is not None:
+            elapsed = now - self.last[0]
+            summary['up_bps'] = round((up - self.last[1]) * 8 / elapsed)
+            summary['down_bps'] = round((down - self.last[2]) * 8 / elapsed)
+        self.last = (now, up, down)
+        connect = Histogram()
+        for histogram in self.connect.values():
+            connect.merge(histogram)
+        summary['connect_p50'] = connect.quantile(0.5)
+        summary['connect_p99'] = connect.quantile(0.99)
+        summary['duration_p50'] = self.duration.quantile(0.5)
+        summary['duration_p99'] = self.duration.quantile(0.99)
+        for name, totals in (('top_clients', clients), ('top_upstreams', upstreams)):
+            busiest = sorted(totals.items(), key=lambda item: -item[1][1] - item[1][2])[:top]
+            summary[name] = [[key, counts[1], counts[2]] for key, counts in busiest]
+        return summary
+
+
+# accept errors which pass once connections close
+RESOURCE_ERRORS = (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM)
+
+
+class Proxy:
+    """Relay the connections accepted on a local address to the upstreams.
+
+    Args:
+        balancer: Balancer choosing the upstream of every connection
+        buffer_size: Bytes read at once per direction of a connection
+        splice: Whether to relay with splice(2), without copying the
+            data to user space
+        health_interval: Seconds between health checks of the upstreams,
+            0 to only eject them on failed client connects
+        idle_timeout: Seconds without data in either direction after which
+            a connection is closed, 0 for none
+        timeout: Longest lifetime of a connection (seconds), 0 for none
+        max_connections: Number of connections relayed at once, the
+            others wait in the listen backlog
+        drain_timeout: Seconds SIGTERM waits for the open connections
+            before closing them
+        metrics_addr: ip:port serving the stats to Prometheus over HTTP,
+            None for none
+        stats_interval: Seconds between JSON summaries of the stats, 0 for none
+        stats_file: File the summaries are appended to, None for stdout
+        metrics_clients: Number of busiest client hosts labelled in the
+            Prometheus metrics, the others are summed as 'other'
+    """
+
+    def __init__(self, balancer, buffer_size=256 * 1024, splice=False, health_interval=5.0,
+                 idle_timeout=0, timeout=0, max_connections=10000, drain_timeout=30.0,
+                 metrics_addr=None, stats_interval=0, stats_file=None, metrics_clients=20):
+        if splice and not hasattr(os, 'splice'):
+            raise RuntimeError('--splice needs Linux and Python 3.10+')
+        self.balancer = balancer
+        self.buffer_size = buffer_size
+        self.splice = splice
+        self.health_interval = health_interval
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.drain_timeout = drain_timeout
+        self.metrics_addr = metrics_addr
+        self.stats_interval = stats_interval
+        self.stats_file = stats_file
+        self.stats = Stats(top_clients=metrics_clients)
+        self.sock = None
+        self.connections = set()
+        self.accepting = None
+        self.room = None
+        self.stopping = False
+
+    async def serve(self, local_addr: str, reuse_port=False):
+        """Accept connections until SIGTERM, then drain the open ones.
+
+        reuse_port: bind with SO_REUSEPORT, the kernel spreads the
+            connections over the processes bound to the same address
+        """
+        loop = asyncio.get_running_loop()
+        self.sock = socket.create_server(parse_addr(local_addr), backlog=1024,
+                                         reuse_port=reuse_port)
+        self.sock.setblocking(False)
+        print('serving on {} in process {}'.format(self.sock.getsockname(), os.getpid()))
+        self.room = asyncio.Event()
+        self.accepting = loop.create_task(self.accept())
+        try:
+            loop.add_signal_handler(signal.SIGTERM, self.stop)
+        except (NotImplementedError, RuntimeError):
+            pass
+        tasks = []
+        if self.health_interval:
+            tasks.append(loop.create_task(self.balancer.check_health(self.health_interval)))
+        if self.balancer.pool_size:
+            tasks.extend(loop.create_task(self.balancer.fill(upstream))
+                         for upstream in self.balancer.upstreams)
+        if self.idle_timeout or self.timeout:
+            tasks.append(loop.create_task(self.sweep()))
+        if self.stats_interval:
+            tasks.append(loop.create_task(self.report()))
+        metrics = None
+        if self.metrics_addr:
+            host, port = parse_addr(self.metrics_addr)
+            metrics = await asyncio.start_server(self.serve_metrics, host, port)
+        try:
+            await self.accepting
+        except asyncio.CancelledError:
+            if not self.stopping:
+                raise
+        finally:
+            self.sock.close()
+        try:
+            await self.drain(self.drain_timeout)
+        finally:
+            for task in tasks:
+                task.cancel()
+            if metrics is not None:
+                metrics.close()
+            self.balancer.close()
+
+    def stop(self):
+        """Stop accepting, serve() returns once the connections are drained."""
+        self.stopping = True
+        self.accepting.cancel()
+
+    async def accept(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if len(self.connections) >= self.max_connections:
+                # the kernel keeps the next clients in the backlog meanwhile
+                self.room.clear()
+                await self.room.wait()
+            try:
+                client, address = await loop.sock_accept(self.sock)
+            except ConnectionAbortedError:
+                continue
+            except OSError as e:
+                if e.errno not in RESOURCE_ERRORS:
+                    raise
+                # out of file descriptors or memory, the open connections
+                # go on and the next clients wait in the backlog
+                print('accept failed, pausing: {}'.format(e))
+                self.room.clear()
+                try:
+                    await asyncio.wait_for(self.room.wait(), 1)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            connection = Connection(address)
+            self.connections.add(connection)
+            connection.task = loop.create_task(self.handle(client, connection))
+
+    async def drain(self, timeout):
+        """Wait for the open connections for up to timeout seconds, then
+        abort the rest.
+        """
+        if not self.connections:
+            return
+        print('draining {} connections'.format(len(self.connections)))
+        tasks = [connection.task for connection in self.connections]
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        for connection in list(self.connections):
+            connection.abort('shutdown')
+        if pending:
+            print('closed {} connections still open'.format(len(pending)))
+            await asyncio.wait(pending)
+
+    async def sweep(self):
+        """Abort the connections idle or open for too long."""
+        loop = asyncio.get_running_loop()
+        interval = min(t for t in (self.idle_timeout, self.timeout) if t) / 4
+        while True:
+            await asyncio.sleep(interval)
+            now = loop.time()
+            for connection in list(self.connections):
+                nbytes = sum(connection.traffic())
+                if nbytes != connection.last_bytes:
+                    connection.last_bytes = nbytes
+                    connection.idle_since = now
+                elif self.idle_timeout and now - connection.idle_since >= self.idle_timeout:
+                    connection.abort('idle')
+                if self.timeout and now - connection.opened >= self.timeout:
+                    connection.abort('timeout')
+
+    async def report(self):
+        """Write a JSON summary of the stats every stats_interval seconds."""
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            line = json.dumps(self.stats.summary(self.connections))
+            if self.stats_file:
+                with open(self.stats_file, 'a') as fp:
+                    fp.write(line + '\n')
+            else:
+                print(line, flush=True)
+
+    async def serve_metrics(self, reader, writer):
+        """Answer any HTTP request with the stats in the Prometheus format."""
+        try:
+            await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 10)
+            body = self.stats.prometheus(self.connections, self.balancer).encode()
+            writer.write(b'HTTP/1.1 200 OK\r\n'
+                         b'Content-Type: text/plain; version=0.0.4\r\n'
+                         b'Content-Length: %d\r\nConnection: close\r\n\r\n' % len(body) + body)
+            await writer.drain()
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle(self, client, connection):
+        address = connection.address
+        print('connection from', address)
+        reason = 'eof'
+        try:
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            started = time.monotonic()
+            try:
+                backend, upstream = await self.balancer.connect(address[0])
+            except OSError as e:
+                print(e)
+                client.close()
+                reason = 'no_upstream'
+                return
+            self.stats.connected(connection, backend, time.monotonic() - started)
+            try:
+                await self.relay(client, upstream, connection)
+            except OSError as e:
+                print(e)
+                reason = 'error'
+            finally:
+                self.balancer.release(backend)
+            if connection.reason is not None:
+                reason = connection.reason
+            elif connection.done.done() and connection.done.result() is not None:
+                reason = 'error'
+        finally:
+            self.stats.finished(connection, reason)
+            self.connections.discard(connection)
+            if len(self.connections) < self.max_connections:
+                self.room.set()
+
+    async def relay(self, client, upstream, connection):
+        if self.splice:
+            sides = [Splice(connection, client, upstream, self.buffer_size),
+                     Splice(connection, upstream, client, self.buffer_size)]
+            for side in sides:
+                side.start()
+            try:
+                await connection.done
+            finally:
+                for side in sides:
+                    side.stop()
+                client.close()
+                upstream.close()
+        else:
+            loop = asyncio.get_running_loop()
+            downstream = Relay(connection, self.buffer_size)
+            upstream_relay = Relay(connection, self.buffer_size)
+            downstream.peer, upstream_relay.peer = upstream_relay, downstream
+            try:
+                await loop.connect_accepted_socket(lambda: downstream, client)
+                await loop.create_connection(lambda: upstream_relay, sock=upstream)
+            except BaseException:
+                for relay, sock in ((downstream, client), (upstream_relay, upstream)):
+                    if relay.transport is None:
+                        sock.close()
+                    else:
+                        relay.transport.close()
+                raise
+            try:
+                await connection.done
+            finally:
+                # cancelled, or aborted before the transports existed
+                if connection.reason is not None or not connection.done.done():
+                    connection.abort(connection.reason)
+
+
+class Supervisor:
+    """Run workers in child processes and restart the ones which die.
+
+    SIGINT or SIGTERM stops the workers with SIGTERM, the ones still
+    running after drain_timeout seconds are killed. The index of its slot,
+    kept by a restarted worker, is appended to the arguments of a worker.
+    """
+
+    def __init__(self, target, args, num_workers, drain_timeout=30.0):
+        self.target = target
+        self.args = args
+        self.num_workers = num_workers
+        self.drain_timeout = drain_timeout
+        self.workers = {}
+        self.stopping = False
+
+    def spawn(self, index):
+        process = multiprocessing.Process(target=self.target, args=self.args + (index,),
+                                          daemon=True)
+        process.start()
+        self.workers[process.sentinel] = (process, time.monotonic(), index)
+
+    def stop(self, signum, frame):
+        self.stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        for index in range(self.num_workers):
+            self.spawn(index)
+        while not self.stopping:
+            for sentinel in multiprocessing.connection.wait(list(self.workers), timeout=1):
+                process, started, index = self.workers.pop(sentinel)
+                process.join()
+                if self.stopping:
+                    break
+                print('worker {} exited with {}, restarting'.format(
+                    process.pid, process.exitcode))
+                # a worker which dies at once would otherwise be respawned in a loop
+                if time.monotonic() - started < 1:
+                    time.sleep(1)
+                self.spawn(index)
+
+        for process, _, _ in self.workers.values():
+            process.terminate()
+        deadline = time.monotonic() + self.drain_timeout
+        for process, _, _ in self.workers.values():
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                process.kill()
+                process.join()
+
+
+def run(args, reuse_port=False, index=0):
+    """Run a proxy configured by the command line arguments until stopped.
+
+    index: number of the worker, its metrics port is the given one + index
+    """
+    if args.uvloop:
+        try:
+            import uvloop
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        except ImportError:
+            pass
+    balancer = Balancer(args.remote, args.balance, args.connect_timeout, pool_size=args.pool)
+    metrics_addr = None
+    if args.metrics:
+        host, port = parse_addr(args.metrics)
+        metrics_addr = '{}:{}'.format(host, port + index)
+    proxy = Proxy(balancer, args.buffer_size, args.splice, args.health_interval,
+                  args.idle_timeout, args.timeout, args.max_connections, args.drain_timeout,
+                  metrics_addr, args.stats_interval, args.stats_file, args.metrics_clients)
     try:
-        loop.run_forever()
-    except KeyboardInterrupt:
+        asyncio.run(proxy.serve(args.local, reuse_port))
+    except (KeyboardInterrupt, asyncio.CancelledError):
         pass
 
-    server.close()
-    loop.run_until_complete(server.wait_closed())
-    loop.close()
+
+def worker(args, index):
+    # the supervisor decides when the workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    run(args, reuse_port=True, index=index)
+
+
+def main(args):
+    if args.workers > 1:
+        # the workers get a moment to close what is left after their drain
+        Supervisor(worker, (args,), args.workers, args.drain_timeout + 5).run()
+    else:
+        run(args)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='a simple tcp proxy.')
 
     parser.add_argument('-l', '--local', type=str, required=True, help='local ip:port')
-    parser.add_argument('-r', '--remote', type=str, required=True, help='remote ip:port')
+    parser.add_argument('-r', '--remote', type=str, required=True, action='append',
+                        help='remote ip:port, repeat it for several upstreams')
+    parser.add_argument('--balance', choices=Balancer.STRATEGIES, default='round-robin',
+                        help='how connections are spread over the upstreams')
+    parser.add_argument('--connect-timeout', type=float, default=5.0,
+                        help='seconds to connect to an upstream before trying another')
+    parser.add_argument('--pool', type=int, default=0,
+                        help='idle connections kept open to every upstream')
+    parser.add_argument('--health-interval', type=float, default=5.0,
+                        help='seconds between upstream health checks, 0 to disable')
+    parser.add_argument('--idle-timeout', type=float, default=0,
+                        help='seconds without data after which a connection is closed, '
+                             '0 (default) keeps idle connections open')
+    parser.add_argument('--timeout', type=float, default=0,
+                        help='longest lifetime of a connection in seconds, 0 for none')
+    parser.add_argument('--max-connections', type=int, default=10000,
+                        help='connections relayed at once, the others wait to be accepted')
+    parser.add_argument('--drain-timeout', type=float, default=30.0,
+                        help='seconds SIGTERM waits for the open connections')
+    parser.add_argument('--metrics', type=str, default=None,
+                        help='ip:port serving Prometheus metrics over HTTP, '
+                             'worker n of -w uses port + n')
+    parser.add_argument('--metrics-clients', type=int, default=20,
+                        help='busiest client hosts labelled in the metrics, the others are "other"')
+    parser.add_argument('--stats-interval', type=float, default=0,
+                        help='seconds between JSON summaries of the traffic, 0 for none')
+    parser.add_argument('--stats-file', type=str, default=None,
+                        help='file the JSON summaries are appended to, default stdout')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='worker processes sharing the local port with SO_REUSEPORT')
+    parser.add_argument('--no-uvloop', dest='uvloop', action='store_false',
+                        help='use the asyncio event loop even if uvloop is installed')
+    parser.add_argument('-b', '--buffer-size', type=int, default=256 * 1024,
+                        help='bytes read at once per direction')
+    parser.add_argument('--splice', action='store_true',
+                        help='relay in the kernel with splice(2), Linux only')
 
     args = parser.parse_args()
 
-    main(args.port, args.remote)
+    main(args)
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+"""
+proxy_bench.py - Loopback benchmark of proxy.py.
+
+Usage:
+    python proxy_bench.py throughput -s 2048 -c 4
+    python proxy_bench.py latency -n 2000
+    python proxy_bench.py scaling -w 1 2 4 -d 5
+"""
+
+import argparse
+import multiprocessing
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+PROXY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'proxy.py')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def sink_server():
+    """Start a server which reads everything and answers one byte at EOF,
+    return its address.
+    """
+    server = socket.create_server(('127.0.0.1', 0), backlog=1024)
+
+    def drain(conn):
+        buf = bytearray(1024 * 1024)
+        with conn:
+            while conn.recv_into(buf):
+                pass
+            conn.sendall(b'k')
+
+    def accept():
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=drain, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return '127.0.0.1:%d' % server.getsockname()[1]
+
+
+def ping_server():
+    """Start a server which answers every byte with one byte, return its address."""
+    server = socket.create_server(('127.0.0.1', 0), backlog=1024)
+
+    def answer(conn):
+        with conn:
+            while conn.recv(1):
+                conn.sendall(b'p')
+
+    def accept():
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=answer, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return '127.0.0.1:%d' % server.getsockname()[1]
+
+
+def start_proxy(remote, *options):
+    """Run proxy.py in a child process, return it and its address.
+
+    remote: address of the upstream, or a list of them
+    """
+    local = '127.0.0.1:%d' % free_port()
+    remotes = [remote] if isinstance(remote, str) else remote
+    command = [sys.executable, PROXY, '-l', local]
+    for address in remotes:
+        command += ['-r', address]
+    proc = subprocess.Popen(command + list(options), stdout=subprocess.DEVNULL)
+    host, port = local.split(':')
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection((host, int(port))).close()
+            return proc, local
+        except OSError:
+            if time.monotonic() > deadline:
+                proc.kill()
+                raise
+            time.sleep(0.05)
+
+
+def stop_proxy(proc):
+    """Stop the proxy, return the CPU seconds it used."""
+    proc.send_signal(signal.SIGINT)
+    _, _, usage = os.wait4(proc.pid, 0)
+    proc.returncode = 0
+    return usage.ru_utime + usage.ru_stime
+
+
+def send(address, size, chunk):
+    """Send size bytes to address, then wait for the answer of the sink."""
+    host, port = address.split(':')
+    with socket.create_connection((host, int(port))) as sock:
+        data = memoryview(bytearray(chunk))
+        left = size
+        while left > 0:
+            sock.sendall(data[:min(left, chunk)])
+            left -= chunk
+        sock.shutdown(socket.SHUT_WR)
+        assert sock.recv(1) == b'k'
+
+
+def transfer(address, size, connections, chunk=1024 * 1024):
+    """Send size bytes split over parallel connections, return the seconds taken."""
+    threads = [threading.Thread(target=send, args=(address, size // connections, chunk))
+               for _ in range(connections)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start
+
+
+def bench_throughput(args):
+    """Gbit/s and proxy CPU seconds per GB of the relay modes."""
+    sink = sink_server()
+    size = args.size * 1024 * 1024
+    print('%-22s %10s %14s' % ('mode', 'Gbit/s', 'CPU s/GB'))
+    elapsed = transfer(sink, size, args.connections)
+    print('%-22s %10.2f %14s' % ('direct', size * 8 / elapsed / 1e9, '-'))
+    modes = [('relay -b 16384', ['-b', '16384']),
+             ('relay -b 262144', ['-b', '262144'])]
+    if hasattr(os, 'splice'):
+        modes.append(('splice', ['--splice']))
+    for name, options in modes:
+        proc, local = start_proxy(sink, *options)
+        elapsed = transfer(local, size, args.connections)
+        cpu = stop_proxy(proc)
+        print('%-22s %10.2f %14.3f' % (name, size * 8 / elapsed / 1e9, cpu / (size / 1e9)))
+
+
+def bench_latency(args):
+    """Latency of new client connections with the upstream strategies and pool."""
+    upstreams = [ping_server() for _ in range(args.upstreams)]
+    print('%-28s %10s %10s %10s' % ('options', 'p50 ms', 'p99 ms', 'max ms'))
+    for options in ([], ['--pool', '16'], ['--balance', 'least-conn'],
+                    ['--balance', 'hash', '--pool', '16']):
+        proc, local = start_proxy(upstreams, *options)
+        host, port = local.split(':')
+        # let the pool fill
+        time.sleep(0.5)
+        latencies = []
+        for _ in range(args.number):
+            start = time.perf_counter()
+            with socket.create_connection((host, int(port))) as sock:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                sock.sendall(b'p')
+                sock.recv(1)
+            latencies.append(time.perf_counter() - start)
+        stop_proxy(proc)
+        latencies.sort()
+        print('%-28s %10.3f %10.3f %10.3f' % (
+            ' '.join(options) or 'default', latencies[len(latencies) // 2] * 1e3,
+            latencies[int(len(latencies) * 0.99)] * 1e3, latencies[-1] * 1e3))
+
+
+def connect_loop(address, duration):
+    """Open, ping and close connections to address for duration seconds,
+    return their number.
+    """
+    host, port = address.split(':')
+    count = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        with socket.create_connection((host, int(port))) as sock:
+            sock.sendall(b'p')
+            sock.recv(1)
+        count += 1
+    return count
+
+
+def bench_scaling(args):
+    """Connection rate and throughput by number of worker processes."""
+    upstream = ping_server()
+    sink = sink_server()
+    size = args.size * 1024 * 1024
+    print('%d CPUs' % os.cpu_count())
+    print('%-8s %12s %10s' % ('workers', 'conn/s', 'Gbit/s'))
+    for workers in args.workers:
+        proc, local = start_proxy(upstream, '-w', str(workers))
+        # every worker has to be bound before the clients start
+        time.sleep(1)
+        with multiprocessing.Pool(args.clients) as pool:
+            counts = pool.starmap(connect_loop, [(local, args.duration)] * args.clients)
+        stop_proxy(proc)
+        proc, local = start_proxy(sink, '-w', str(workers))
+        time.sleep(1)
+        elapsed = transfer(local, size, args.connections)
+        stop_proxy(proc)
+        print('%-8d %12.0f %10.2f' % (
+            workers, sum(counts) / args.duration, size * 8 / elapsed / 1e9))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='proxy.py benchmarks.')
+    subparsers = parser.add_subparsers(dest='bench', required=True)
+
+    sub = subparsers.add_parser('throughput', help=bench_throughput.__doc__)
+    sub.add_argument('-s', '--size', type=int, default=2048, help='MB to send')
+    sub.add_argument('-c', '--connections', type=int, default=4)
+    sub.set_defaults(func=bench_throughput)
+
+    sub = subparsers.add_parser('latency', help=bench_latency.__doc__)
+    sub.add_argument('-n', '--number', type=int, default=2000, help='connections')
+    sub.add_argument('-u', '--upstreams', type=int, default=2)
+    sub.set_defaults(func=bench_latency)
+
+    sub = subparsers.add_parser('scaling', help=bench_scaling.__doc__)
+    sub.add_argument('-w', '--workers', type=int, nargs='+', default=[1, 2, 4])
+    sub.add_argument('-d', '--duration', type=float, default=5,
+                     help='seconds of connections per worker count')
+    sub.add_argument('-n', '--clients', type=int, default=8, help='client processes')
+    sub.add_argument('-s', '--size', type=int, default=1024, help='MB to send')
+    sub.add_argument('-c', '--connections', type=int, default=16)
+    sub.set_defaults(func=bench_scaling)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()